@@ -1,11 +1,26 @@
 import streamlit as st
 import gspread
 import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from google.oauth2.service_account import Credentials
-from datetime import datetime, timedelta, time
+from datetime import date, datetime, timedelta, time, timezone
+from email.utils import parsedate_to_datetime
 import requests
+import requests.adapters
 import io
 import os
+import sqlite3
+import threading
+import contextlib
+import random
+import sys
+import hmac
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
 from googleapiclient.discovery import build
 
 import time
@@ -28,13 +43,401 @@ try:
     MAIL_API_TOKEN  = os.getenv("MAIL_API_TOKEN")  or st.secrets["MAIL_API_TOKEN"]
     MAIL_FROM_EMAIL = os.getenv("MAIL_FROM_EMAIL") or st.secrets.get("MAIL_FROM_EMAIL", "testing@dismac.com.bo")
     MAIL_FROM_NAME  = os.getenv("MAIL_FROM_NAME")  or st.secrets.get("MAIL_FROM_NAME", "Dismac Marketplace")
+    GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME") or st.secrets["GOOGLE_SHEET_NAME"]
+    GOOGLE_SHEET_ID   = os.getenv("GOOGLE_SHEET_ID")   or st.secrets.get("GOOGLE_SHEET_ID", "")
+    MAIL_POOL_SIZE  = int(os.getenv("MAIL_POOL_SIZE") or st.secrets.get("MAIL_POOL_SIZE", 4))
 except KeyError as e:
     st.error(f"🔒 Falta configuración: {e}")
     st.stop()
 
+# Storage backend: "sheets" (Google Sheets only) or "sqlite" (local DB, Sheets kept as exported mirror;
+# with the mirror, credentials and gestion are still read from Sheets, where staff maintain them)
+STORAGE_BACKEND = (os.getenv("STORAGE_BACKEND") or st.secrets.get("STORAGE_BACKEND", "sheets")).lower()
+SQLITE_PATH     = os.getenv("SQLITE_PATH")     or st.secrets.get("SQLITE_PATH", "almacen.db")
+SHEETS_MIRROR   = str(os.getenv("SHEETS_MIRROR") or st.secrets.get("SHEETS_MIRROR", "true")).lower() == "true"
+# Sheets write path: "append" (append + confirm written range) or "legacy" (row count + full-sheet verification)
+SHEETS_WRITE_MODE = (os.getenv("SHEETS_WRITE_MODE") or st.secrets.get("SHEETS_WRITE_MODE", "append")).lower()
+# Local ledger file used to serialize slot claims across server processes
+LEDGER_PATH     = os.getenv("LEDGER_PATH")     or st.secrets.get("LEDGER_PATH", "booking_ledger.db")
+# Durable queue for confirmation emails (drained by a background worker)
+MAIL_OUTBOX_PATH = os.getenv("MAIL_OUTBOX_PATH") or st.secrets.get("MAIL_OUTBOX_PATH", "mail_outbox.db")
+# Last good Sheets dataset, served right after a restart while Sheets reloads ("" disables)
+SNAPSHOT_PATH   = os.getenv("SNAPSHOT_PATH", st.secrets.get("SNAPSHOT_PATH", "sheets_snapshot.bin"))
+# Cache shared by the server processes of this host (downloads and invalidations; "" disables)
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", st.secrets.get("SHARED_CACHE_PATH", "shared_cache.db"))
+# Cache TTLs per table (seconds): credentials/gestion change rarely, reservas often
+CACHE_TTL_CREDENCIAL = int(os.getenv("CACHE_TTL_CREDENCIAL") or st.secrets.get("CACHE_TTL_CREDENCIAL", 300))
+CACHE_TTL_RESERVAS   = int(os.getenv("CACHE_TTL_RESERVAS")   or st.secrets.get("CACHE_TTL_RESERVAS", 30))
+CACHE_TTL_GESTION    = int(os.getenv("CACHE_TTL_GESTION")    or st.secrets.get("CACHE_TTL_GESTION", 300))
+# Refresh reservas in a background thread before its TTL runs out
+BACKGROUND_REFRESH   = str(os.getenv("BACKGROUND_REFRESH") or st.secrets.get("BACKGROUND_REFRESH", "true")).lower() == "true"
+# Before reloading an expired table, ask Drive (or the SQLite file) whether anything changed
+CHANGE_PROBE         = str(os.getenv("CHANGE_PROBE") or st.secrets.get("CHANGE_PROBE", "true")).lower() == "true"
+# Incremental reservas sync does a full reload at least this often (seconds)
+RESERVAS_FULL_RELOAD = int(os.getenv("RESERVAS_FULL_RELOAD") or st.secrets.get("RESERVAS_FULL_RELOAD", 600))
+# Delivery duration by size, "min_bultos:minutes" steps (rounded up to whole slots)
+BOOKING_DURATIONS    = os.getenv("BOOKING_DURATIONS") or st.secrets.get("BOOKING_DURATIONS", "1:20,4:40,8:60")
+# Unloading docks (andenes) that can each receive one delivery per slot
+DOCK_COUNT           = max(1, int(os.getenv("DOCK_COUNT") or st.secrets.get("DOCK_COUNT", 1)))
+# Overall time budget (seconds, backoff included) for one Sheets / mail operation
+SHEETS_RETRY_DEADLINE = float(os.getenv("SHEETS_RETRY_DEADLINE") or st.secrets.get("SHEETS_RETRY_DEADLINE", 20))
+MAIL_RETRY_DEADLINE   = float(os.getenv("MAIL_RETRY_DEADLINE") or st.secrets.get("MAIL_RETRY_DEADLINE", 15))
+# Sheets API requests per minute this process may spend (keep below the project quota)
+SHEETS_QUOTA_PER_MINUTE = int(os.getenv("SHEETS_QUOTA_PER_MINUTE") or st.secrets.get("SHEETS_QUOTA_PER_MINUTE", 60))
+# Share of that budget held back for bookings (user reads stop above it, background refreshes at twice it)
+SHEETS_QUOTA_RESERVE  = float(os.getenv("SHEETS_QUOTA_RESERVE") or st.secrets.get("SHEETS_QUOTA_RESERVE", 0.2))
+# Consecutive failed Sheets operations that open the circuit (read-only mode), and the recovery probe interval (seconds)
+SHEETS_BREAKER_THRESHOLD = int(os.getenv("SHEETS_BREAKER_THRESHOLD") or st.secrets.get("SHEETS_BREAKER_THRESHOLD", 3))
+SHEETS_BREAKER_PROBE_INTERVAL = float(os.getenv("SHEETS_BREAKER_PROBE_INTERVAL") or st.secrets.get("SHEETS_BREAKER_PROBE_INTERVAL", 30))
+# Oldest reservas snapshot the final booking check accepts (seconds)
+FINAL_CHECK_MAX_AGE  = int(os.getenv("FINAL_CHECK_MAX_AGE") or st.secrets.get("FINAL_CHECK_MAX_AGE", 10))
+# A ledger claim whose booking is still missing from the sheet this long after the claim is dropped (seconds)
+LEDGER_CLAIM_GRACE   = int(os.getenv("LEDGER_CLAIM_GRACE") or st.secrets.get("LEDGER_CLAIM_GRACE", 120))
+# Working calendar, optional [work_calendar] secrets table (missing keys use DEFAULT_WORK_CALENDAR):
+#   slot_minutes = 20
+#   weekly = { lun = "9:00-16:00", mar = "9:00-16:00", ..., sab = "9:00-12:00" }
+#   holidays = ["2025-12-25"]
+#   special_days = { "2025-12-24" = "9:00-15:00" }
+WORK_CALENDAR = dict(st.secrets.get("work_calendar", {}))
+
 # ─────────────────────────────────────────────────────────────
 # 2. Google Sheets Functions - MIGRATED FROM SHAREPOINT
 # ─────────────────────────────────────────────────────────────
+class TransientError(Exception):
+    """Condition worth retrying that is not an HTTP error (e.g. a write not visible yet)"""
+
+
+class QuotaExhaustedError(Exception):
+    """No Sheets request budget left for this priority within the allowed wait"""
+
+
+class CircuitOpenError(Exception):
+    """The backend is known to be down; the call was not attempted"""
+
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def retry_after_seconds(value):
+    """Retry-After header (seconds or HTTP date) -> seconds, or None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def classify_error(error):
+    """(HTTP status or None, retryable, Retry-After seconds or None) for a Sheets / Drive / mail exception"""
+    if isinstance(error, TransientError):
+        return None, True, None
+    # gspread APIError and requests HTTPError carry a requests.Response
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    headers = getattr(response, 'headers', None) or {}
+    if status is None and getattr(error, 'resp', None) is not None:
+        # googleapiclient HttpError: httplib2 response, a dict of lower-cased headers
+        status, headers = int(error.resp.status), error.resp
+    if status is not None:
+        return status, status in RETRYABLE_STATUS, retry_after_seconds(headers.get('retry-after') or headers.get('Retry-After'))
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return None, True, None
+    return None, False, None
+
+
+# monotonic deadline of the RetryPolicy attempt running on this thread (see request_timeout)
+_retry_deadline = threading.local()
+
+def request_timeout(limit=None):
+    """Timeout for one network request: `limit`, cut to what is left of the running RetryPolicy deadline"""
+    deadline = getattr(_retry_deadline, 'at', None)
+    if deadline is None:
+        return limit
+    remaining = max(0.1, deadline - time.monotonic())
+    return remaining if limit is None else min(limit, remaining)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by attempts and an overall deadline.
+
+    Only 429/5xx, connection errors and TransientError are retried, and a
+    Retry-After hint replaces the computed delay. A wait that would overrun
+    the deadline is not started: the last error is raised instead. Each
+    attempt publishes the deadline to request_timeout(), so a hung request
+    cannot outlive it either.
+    """
+
+    def __init__(self, name, deadline, max_attempts=5, base_delay=0.5, max_delay=8.0, limiter=None, breaker=None):
+        self.name = name
+        self.deadline = deadline
+        self.limiter = limiter  # QuotaLimiter charged one token per attempt
+        self.breaker = breaker  # CircuitBreaker fed one outcome per operation
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def run(self, operation, fn, idempotent=True, max_attempts=None):
+        """Call fn() until it succeeds or the policy gives up.
+
+        Non-idempotent calls (appends, sends) are retried only when the request
+        was rejected before taking effect: 429 or a connect timeout.
+        """
+        if self.breaker is None:
+            return self._run(operation, fn, idempotent, max_attempts)
+        self.breaker.before_call(f"{self.name}.{operation}")
+        try:
+            result = self._run(operation, fn, idempotent, max_attempts)
+        except Exception as e:
+            self.breaker.record(e)
+            raise
+        self.breaker.record(None)
+        return result
+
+    def _run(self, operation, fn, idempotent, max_attempts):
+        max_attempts = max_attempts or self.max_attempts
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.limiter is not None:
+                # Waiting for budget counts against the deadline
+                self.limiter.acquire(timeout=max(0.0, self.deadline - (time.monotonic() - started)))
+            outer = getattr(_retry_deadline, 'at', None)
+            _retry_deadline.at = started + self.deadline if outer is None else min(outer, started + self.deadline)
+            try:
+                return fn()
+            except Exception as e:
+                status, retryable, retry_after = classify_error(e)
+                if status == 429 and self.limiter is not None:
+                    self.limiter.drain()
+                if not idempotent:
+                    retryable = status == 429 or isinstance(e, requests.ConnectTimeout)
+                if not retryable or attempt >= max_attempts:
+                    raise
+                delay = retry_after if retry_after is not None else random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+                )
+                if time.monotonic() - started + delay > self.deadline:
+                    raise
+                log_booking_attempt("RETRY", f"{self.name}.{operation} attempt {attempt} (status {status}), waiting {delay:.1f}s", error=str(e))
+                time.sleep(delay)
+            finally:
+                _retry_deadline.at = outer
+
+
+SHEETS_PRIORITY_HIGH = 0        # booking writes and final checks
+SHEETS_PRIORITY_NORMAL = 1      # user-facing reads
+SHEETS_PRIORITY_BACKGROUND = 2  # refreshes and exports nobody waits on
+
+_sheets_priority = threading.local()
+
+@contextlib.contextmanager
+def sheets_priority(level):
+    """Run the block (or decorated function) with Sheets calls charged at `level`"""
+    previous = getattr(_sheets_priority, 'level', SHEETS_PRIORITY_NORMAL)
+    _sheets_priority.level = level
+    try:
+        yield
+    finally:
+        _sheets_priority.level = previous
+
+
+class QuotaLimiter:
+    """Process-wide token bucket sized to the Sheets per-minute quota.
+
+    Each priority may only spend down to its floor, so user reads leave the
+    reserve to bookings and background refreshes stop well before that.
+    Bookings and user reads wait for their floor to refill, within the
+    caller's timeout (the RetryPolicy deadline); only background work fails
+    fast instead of queueing behind the quota.
+    """
+
+    def __init__(self, per_minute, reserve=0.2):
+        self.capacity = float(max(1, per_minute))
+        self.rate = self.capacity / 60.0  # tokens per second
+        reserve = self.capacity * min(max(reserve, 0.0), 0.5)
+        self._floors = {
+            SHEETS_PRIORITY_HIGH: 0.0,
+            SHEETS_PRIORITY_NORMAL: reserve,
+            SHEETS_PRIORITY_BACKGROUND: min(2 * reserve, self.capacity - 1),
+        }
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._granted = []  # monotonic times of the requests let through in the last minute
+        self._denied = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=0.0):
+        """Take one token at the calling thread's priority, waiting at most `timeout` seconds.
+
+        Background work never waits. Raises QuotaExhaustedError when out of budget.
+        """
+        level = getattr(_sheets_priority, 'level', SHEETS_PRIORITY_NORMAL)
+        floor = self._floors[level]
+        if level == SHEETS_PRIORITY_BACKGROUND:
+            timeout = 0.0
+        give_up = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens - 1 >= floor:
+                    self._tokens -= 1
+                    self._granted.append(now)
+                    return
+                wait = (floor + 1 - self._tokens) / self.rate
+                if now + wait > give_up:
+                    self._denied += 1
+                    raise QuotaExhaustedError(f"Sheets quota exhausted for priority {level} ({self._tokens:.1f} tokens left)")
+            time.sleep(wait)
+
+    def drain(self):
+        """The API answered 429: our estimate was optimistic, so start over from empty"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = 0.0
+
+    def usage(self):
+        """Current budget: capacity, available tokens, requests in the last minute, denials"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._granted = [stamp for stamp in self._granted if now - stamp < 60]
+            return {
+                'capacity': int(self.capacity),
+                'available': int(self._tokens),
+                'used_last_minute': len(self._granted),
+                'denied': self._denied,
+                'level': self._tokens / self.capacity,
+            }
+
+    def constrained(self):
+        """True when user reads are close to their floor (callers should lean on the cache)"""
+        return self.usage()['available'] <= self._floors[SHEETS_PRIORITY_NORMAL] + 1
+
+
+def write_rejected(error):
+    """True when a failed write provably did not take effect: refused before it was
+    sent (breaker, quota, slot check) or rejected by the API (4xx, connect timeout)"""
+    if isinstance(error, StorageError):
+        return error.applied is False
+    if isinstance(error, (SlotTakenError, CircuitOpenError, QuotaExhaustedError, requests.ConnectTimeout)):
+        return True
+    status, _, _ = classify_error(error)
+    return status is not None and 400 <= status < 500
+
+def is_outage(error):
+    """True for failures that say the backend is unavailable (5xx, 429, network), not that the call was wrong"""
+    status, _, _ = classify_error(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class CircuitBreaker:
+    """Fail fast while a backend is down.
+
+    After `threshold` consecutive outage failures the circuit opens: calls
+    raise CircuitOpenError without touching the network, and a background
+    thread runs `probe` every `probe_interval` seconds until it succeeds and
+    closes the circuit again.
+    """
+
+    def __init__(self, name, probe, threshold=3, probe_interval=30):
+        self.name = name
+        self.probe = probe
+        self.threshold = max(1, threshold)
+        self.probe_interval = probe_interval
+        self._failures = 0
+        self._opened_at = None  # time.time() when opened, None while closed
+        self._prober = None
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def before_call(self, operation):
+        if self.is_open():
+            raise CircuitOpenError(f"{self.name} unavailable, {operation} not attempted")
+
+    def record(self, error):
+        """Outcome of one operation: None for success, else the exception it raised"""
+        if error is None:
+            with self._lock:
+                self._failures = 0
+            return
+        if not is_outage(error):
+            return
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is not None or self._failures < self.threshold:
+                return
+            self._opened_at = time.time()
+            if self._prober is None or not self._prober.is_alive():
+                self._prober = threading.Thread(target=self._probe_until_closed, name=f"probe-{self.name}", daemon=True)
+                self._prober.start()
+        log_booking_attempt("CIRCUIT_OPEN", f"{self.name} after {self.threshold} failures", success=False, error=str(error))
+
+    def _probe_until_closed(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception as e:
+                log_booking_attempt("CIRCUIT_PROBE_FAILED", self.name, error=str(e))
+                continue
+            with self._lock:
+                self._failures = 0
+                self._opened_at = None
+            log_booking_attempt("CIRCUIT_CLOSED", f"{self.name} recovered", success=True)
+            return
+
+
+def _probe_sheets():
+    """Cheapest Sheets read: one cell of reservas, outside the breaker and the retry policy"""
+    with sheets_priority(SHEETS_PRIORITY_BACKGROUND):
+        SHEETS_QUOTA.acquire()
+    handles = get_sheet_handles()
+    handles.invalidate()
+    gc = setup_google_sheets()
+    if not gc:
+        raise StorageError("1", "Failed to connect to Google Sheets")
+    spreadsheet = gc.open_by_key(GOOGLE_SHEET_ID) if GOOGLE_SHEET_ID else gc.open(GOOGLE_SHEET_NAME)
+    spreadsheet.values_get(f"{RESERVAS_TABLE}!A1")
+
+
+SHEETS_QUOTA = QuotaLimiter(SHEETS_QUOTA_PER_MINUTE, SHEETS_QUOTA_RESERVE)
+SHEETS_BREAKER = CircuitBreaker("sheets", _probe_sheets, SHEETS_BREAKER_THRESHOLD, SHEETS_BREAKER_PROBE_INTERVAL)
+SHEETS_RETRY = RetryPolicy("sheets", SHEETS_RETRY_DEADLINE, limiter=SHEETS_QUOTA, breaker=SHEETS_BREAKER)
+MAIL_RETRY = RetryPolicy("mail", MAIL_RETRY_DEADLINE, max_attempts=3)
+# Drive has its own quota, but is down whenever Sheets is: same breaker, short deadline
+DRIVE_RETRY = RetryPolicy("drive", 5, max_attempts=2, breaker=SHEETS_BREAKER)
+
+class DeadlineHTTPClient(gspread.HTTPClient):
+    """gspread HTTP client whose per-request timeout follows request_timeout().
+
+    set_timeout() still sets the upper bound; inside SHEETS_RETRY each request
+    only gets what is left of the policy deadline. Read per thread, so
+    concurrent callers sharing the client do not race on it.
+    """
+
+    @property
+    def timeout(self):
+        return request_timeout(self._timeout_limit)
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout_limit = value
+
+
 @st.cache_resource
 def setup_google_sheets():
     """Configurar conexión a Google Sheets"""
@@ -45,102 +448,1877 @@ def setup_google_sheets():
             "https://www.googleapis.com/auth/drive"
         ]
         credentials = Credentials.from_service_account_info(credentials_info, scopes=scopes)
-        gc = gspread.authorize(credentials)
+        gc = gspread.authorize(credentials, http_client=DeadlineHTTPClient)
+        gc.set_timeout(SHEETS_RETRY_DEADLINE)
         return gc
     except Exception as e:
         st.error(f"❌ Error conectando: {str(e)}")
         return None
 
-@st.cache_data(ttl=60, show_spinner=False)  # Reduced TTL for real-time booking
-def download_sheets_to_memory():
-    """Download all sheets from Google Sheets - REPLACES SharePoint Excel download"""
-    try:
-        gc = setup_google_sheets()
-        if not gc:
-            return None, None, None
-        
-        spreadsheet = gc.open(st.secrets["GOOGLE_SHEET_NAME"])
-        
-        # Load credentials sheet
+
+class SheetHandles:
+    """Spreadsheet and worksheet objects opened once (by key) and reused.
+
+    Opening by name is a Drive search and every spreadsheet.worksheet() call
+    is a metadata fetch; both now happen only on first use or after
+    invalidate() following an API error.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._spreadsheet = None
+        self._worksheets = {}
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None:
+                gc = setup_google_sheets()
+                if not gc:
+                    raise StorageError("1", "Failed to connect to Google Sheets")
+                if GOOGLE_SHEET_ID:
+                    self._spreadsheet = SHEETS_RETRY.run("open_by_key", lambda: gc.open_by_key(GOOGLE_SHEET_ID))
+                else:
+                    self._spreadsheet = SHEETS_RETRY.run("open", lambda: gc.open(GOOGLE_SHEET_NAME))
+                    log_booking_attempt("SHEET_OPENED_BY_NAME", f"Set GOOGLE_SHEET_ID={self._spreadsheet.id} to skip the Drive search")
+            return self._spreadsheet
+
+    def worksheet(self, title):
+        spreadsheet = self.spreadsheet()
+        with self._lock:
+            worksheet = self._worksheets.get(title)
+            if worksheet is None:
+                # One metadata call returns every worksheet
+                self._worksheets = {ws.title: ws for ws in SHEETS_RETRY.run("worksheets", spreadsheet.worksheets)}
+                worksheet = self._worksheets.get(title)
+        if worksheet is None:
+            raise gspread.WorksheetNotFound(title)
+        return worksheet
+
+    def invalidate(self):
+        """Drop cached handles so the next call reopens them"""
+        with self._lock:
+            self._spreadsheet = None
+            self._worksheets = {}
+
+
+@st.cache_resource
+def setup_drive_service():
+    """Drive v3 client, used only for cheap file metadata probes"""
+    try:
+        credentials_info = dict(st.secrets["google_service_account"])
+        scopes = ["https://www.googleapis.com/auth/drive.metadata.readonly"]
+        credentials = Credentials.from_service_account_info(credentials_info, scopes=scopes)
+        return build("drive", "v3", credentials=credentials, cache_discovery=False)
+    except Exception as e:
+        log_booking_attempt("DRIVE_SETUP_FAILED", "", error=str(e))
+        return None
+
+
+class DriveChangeProbe:
+    """Spreadsheet version token from Drive files.get (modifiedTime + version).
+
+    `drive_service` only needs the googleapiclient files().get(...).execute()
+    shape, so a fake client can drive it in tests. A result is reused for
+    `min_interval` seconds so a burst of cache lookups costs one request.
+    With a RetryPolicy the request goes through its retries and breaker, and
+    no request is made at all (None: version unknown) while the breaker is open.
+    """
+
+    def __init__(self, drive_service, file_id, min_interval=2, policy=None):
+        self.drive_service = drive_service
+        self.file_id = file_id
+        self.min_interval = min_interval
+        self.policy = policy
+        self._last = None  # (checked_at, token)
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self._last is not None and time.monotonic() - self._last[0] < self.min_interval:
+                return self._last[1]
+        if self.policy is not None and self.policy.breaker is not None and self.policy.breaker.is_open():
+            return None
+        request = self.drive_service.files().get(
+            fileId=self.file_id, fields="modifiedTime,version", supportsAllDrives=True
+        )
+        response = request.execute() if self.policy is None else self.policy.run("files.get", request.execute)
+        token = (response.get("modifiedTime"), response.get("version"))
+        with self._lock:
+            self._last = (time.monotonic(), token)
+        return token
+
+
+@st.cache_resource
+def get_sheet_handles():
+    """Process-wide SheetHandles"""
+    return SheetHandles()
+
+# Table names and default headers for the three proveedor_* tables
+CREDENCIAL_TABLE = "proveedor_credencial"
+RESERVAS_TABLE = "proveedor_reservas"
+GESTION_TABLE = "proveedor_gestion"
+
+CREDENCIAL_COLUMNS = ['usuario', 'password', 'Email', 'cc']
+RESERVAS_COLUMNS = ['Fecha', 'Hora', 'Proveedor', 'Numero_de_bultos', 'Orden_de_compra', 'Anden', 'Estado']
+# Estado of a cancelled booking; the row stays in place so row numbers never shift (empty = active)
+ESTADO_CANCELADA = "Cancelada"
+GESTION_COLUMNS = [
+    'Orden_de_compra', 'Proveedor', 'Numero_de_bultos',
+    'Hora_llegada', 'Hora_inicio_atencion', 'Hora_fin_atencion',
+    'Tiempo_espera', 'Tiempo_atencion', 'Tiempo_total', 'Tiempo_retraso',
+    'numero_de_semana', 'hora_de_reserva'
+]
+
+
+TABLE_LAYOUTS = {
+    CREDENCIAL_TABLE: CREDENCIAL_COLUMNS,
+    RESERVAS_TABLE: RESERVAS_COLUMNS,
+    GESTION_TABLE: GESTION_COLUMNS,
+}
+
+
+def _column_letter(index):
+    """0 -> 'A', 25 -> 'Z', 26 -> 'AA'"""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def _block_rows(blocks, widths=None):
+    """Join side-by-side value blocks into padded rows (widths default to each block's first row)"""
+    if widths is None:
+        widths = [len(block[0]) if block else 0 for block in blocks]
+    height = max((len(block) for block in blocks), default=0)
+    rows = []
+    for r in range(height):
+        row = []
+        for block, width in zip(blocks, widths):
+            cells = block[r] if r < len(block) else []
+            row.extend(list(cells[:width]) + [''] * (width - len(cells)))
+        rows.append(row)
+    return rows
+
+
+def _frame_from_rows(rows):
+    """DataFrame from padded rows whose first row is the header (None if no header).
+
+    The index holds each row's sheet row number (header = row 1).
+    """
+    if not rows or not any(rows[0]):
+        return None
+    header = rows[0]
+    # Drop blank rows (deleted bookings); kept rows still carry their real row number
+    numbered = [(number, row) for number, row in enumerate(rows[1:], start=2)
+                if any(str(cell).strip() for cell in row)]
+    return pd.DataFrame([row for _, row in numbered], columns=header,
+                        index=[number for number, _ in numbered])
+
+
+class StorageError(Exception):
+    """Storage failure carrying the user-facing error code (see save_booking_to_sheets_enhanced).
+
+    `applied` is False when the write provably did not take effect, None when it may have.
+    """
+
+    def __init__(self, code, message, applied=None):
+        super().__init__(message)
+        self.code = code
+        self.applied = applied
+
+
+class SlotTakenError(Exception):
+    """Raised when a booking overlaps slots that are already reserved"""
+
+
+class BookingNotFoundError(Exception):
+    """Raised when a located reservas row no longer holds the expected booking"""
+
+
+def booking_row(booking):
+    """Booking dict -> row in proveedor_reservas column order"""
+    return [
+        booking['Fecha'],
+        booking['Hora'],
+        booking['Proveedor'],
+        str(booking['Numero_de_bultos']),
+        booking['Orden_de_compra'],
+        str(booking.get('Anden', 1)),
+        booking.get('Estado', '')
+    ]
+
+
+def assign_dock(dock_masks, hora):
+    """First dock (1-based) with every slot of `hora` free, or None if all docks are busy"""
+    needed = occupancy_mask([hora])
+    for dock, mask in enumerate(dock_masks, start=1):
+        if not mask & needed:
+            return dock
+    return None
+
+
+class BookingStorage(ABC):
+    """Interface for the proveedor_credencial / proveedor_reservas / proveedor_gestion tables"""
+
+    name = "base"
+    atomic_commit = False  # True if append_reserva checks and writes in one transaction
+    external_tables = frozenset()  # tables read from another system, not covered by version_token()
+
+    @abstractmethod
+    def load_credentials(self):
+        """Credentials table as a DataFrame"""
+
+    @abstractmethod
+    def load_reservas(self):
+        """Reservas table as a DataFrame, indexed by row key"""
+
+    @abstractmethod
+    def load_gestion(self):
+        """Gestion table as a DataFrame"""
+
+    def load_tables(self, tables, previous=None):
+        """{table: DataFrame}; `previous` ({table: last snapshot}) lets a backend sync incrementally"""
+        loaders = {
+            CREDENCIAL_TABLE: self.load_credentials,
+            RESERVAS_TABLE: self.load_reservas,
+            GESTION_TABLE: self.load_gestion,
+        }
+        return {table: loaders[table]() for table in tables}
+
+    def load_all(self):
+        """Return (credentials_df, reservas_df, gestion_df)"""
+        tables = self.load_tables([CREDENCIAL_TABLE, RESERVAS_TABLE, GESTION_TABLE])
+        return tables[CREDENCIAL_TABLE], tables[RESERVAS_TABLE], tables[GESTION_TABLE]
+
+    def version_token(self):
+        """Cheap token that changes whenever the stored data changes (None = unknown)"""
+        return None
+
+    def dock_masks(self, fecha_dia):
+        """Recent booked-slot mask of each dock on fecha_dia ('YYYY-MM-DD').
+
+        Read from the cached occupancy index of a snapshot at most
+        FINAL_CHECK_MAX_AGE seconds old, so repeated checks share one fetch.
+        """
+        reservas_df = get_table_cache().get(RESERVAS_TABLE, max_age=FINAL_CHECK_MAX_AGE)
+        return get_occupancy_index(reservas_df).dock_masks(fecha_dia)
+
+    @abstractmethod
+    def append_reserva(self, booking):
+        """Persist one booking. Raises SlotTakenError or StorageError; returns a status message"""
+
+    @abstractmethod
+    def cancel_reserva(self, row_key, current):
+        """Delete the booking `current` stored at row_key. Raises BookingNotFoundError or StorageError"""
+
+    @abstractmethod
+    def update_reserva(self, row_key, current, booking):
+        """Overwrite the booking `current` at row_key with `booking`. Raises BookingNotFoundError,
+        SlotTakenError (atomic backends) or StorageError"""
+
+
+class GoogleSheetsStorage(BookingStorage):
+    """Google Sheets backend - every read is a full worksheet download"""
+
+    name = "sheets"
+
+    def __init__(self):
+        self.handles = get_sheet_handles()
+        self._drive = setup_drive_service() if CHANGE_PROBE else None
+        self._probe = None
+
+    def version_token(self):
+        if self._drive is None:
+            return None
+        if self._probe is None:
+            self._probe = DriveChangeProbe(self._drive, GOOGLE_SHEET_ID or self.handles.spreadsheet().id,
+                                           policy=DRIVE_RETRY)
+        return self._probe()
+
+    def _read_table(self, title, default_columns):
+        try:
+            worksheet = self.handles.worksheet(title)
+        except gspread.WorksheetNotFound:
+            return None
+        # Raw values, as in the batch path: the index is the sheet row number
+        # even when blank rows are skipped
+        all_values = SHEETS_RETRY.run("get_all_values", worksheet.get_all_values)
+        frame = _frame_from_rows(all_values)
+        return frame if frame is not None else pd.DataFrame(columns=default_columns)
+
+    def load_credentials(self):
+        credentials_df = self._read_table(CREDENCIAL_TABLE, CREDENCIAL_COLUMNS)
+        if credentials_df is None:
+            return pd.DataFrame(columns=CREDENCIAL_COLUMNS)
+        # Ensure all columns are strings for consistency
+        for col in credentials_df.columns:
+            credentials_df[col] = credentials_df[col].astype(str)
+        return credentials_df
+
+    def load_reservas(self):
+        reservas_df = self._read_table(RESERVAS_TABLE, RESERVAS_COLUMNS)
+        if reservas_df is None:
+            return pd.DataFrame(columns=RESERVAS_COLUMNS)
+        present = len(reservas_df.columns)
+        missing = RESERVAS_COLUMNS[present:]
+        if missing and list(reservas_df.columns) == RESERVAS_COLUMNS[:present]:
+            # Sheet predates later columns (Anden, Estado): add their headers so batch reads match the layout
+            try:
+                header_range = f"{_column_letter(present)}1:{_column_letter(len(RESERVAS_COLUMNS) - 1)}1"
+                self.handles.worksheet(RESERVAS_TABLE).update(header_range, [missing])
+            except Exception as e:
+                log_booking_attempt("RESERVAS_HEADER_MIGRATION_FAILED", RESERVAS_TABLE, error=str(e))
+            for col in missing:
+                reservas_df[col] = ''
+        return reservas_df
+
+    def load_gestion(self):
+        gestion_df = self._read_table(GESTION_TABLE, GESTION_COLUMNS)
+        if gestion_df is not None:
+            return gestion_df
+        # Create gestion sheet if it doesn't exist
+        try:
+            gestion_ws = self.handles.spreadsheet().add_worksheet(GESTION_TABLE, rows=100, cols=12)
+            gestion_ws.update('A1:L1', [GESTION_COLUMNS])
+            self.handles.invalidate()
+        except Exception as e:
+            st.warning(f"No se pudo crear hoja de gestión: {e}")
+        return pd.DataFrame(columns=GESTION_COLUMNS)
+
+    def _table_range(self, table, first_row=None):
+        """A1 range over the layout columns of `table`, from `first_row` (default: the header)"""
+        row = first_row or ""
+        return f"'{table}'!A{row}:{_column_letter(len(TABLE_LAYOUTS[table]) - 1)}"
+
+    def load_tables(self, tables, previous=None):
+        """All tables in one values_batch_get request, built straight from the value arrays.
+
+        With a `previous` reservas snapshot only the rows from its last row
+        onwards are requested and appended (reservas is append-only). Falls
+        back to full reads if a sheet is missing (the batch is rejected with
+        a 400), its header does not match the expected layout, or the
+        previous last row was edited. Any other error is raised.
+        """
+        spreadsheet = self.handles.spreadsheet()
+        previous = previous or {}
+
+        ranges, incremental = [], {}
+        for table in tables:
+            basis = previous.get(table)
+            if table == RESERVAS_TABLE and self._can_extend(basis):
+                incremental[table] = basis
+                ranges.append(self._table_range(table, basis.attrs['sheet_rows']))
+            else:
+                ranges.append(self._table_range(table))
+
+        try:
+            value_ranges = SHEETS_RETRY.run(
+                "values_batch_get", lambda: spreadsheet.values_batch_get(ranges)
+            ).get('valueRanges', [])
+        except Exception as e:
+            # Only a rejected range (400: sheet missing or renamed) is worth per-sheet reads;
+            # quota, breaker and outage errors would just fail again N times
+            if classify_error(e)[0] != 400:
+                raise
+            log_booking_attempt("BATCH_READ_FALLBACK", ", ".join(tables), error=str(e))
+            self.handles.invalidate()
+            return self._load_tables_individually(tables)
+
+        result, reload = {}, []
+        for table, block in zip(tables, value_ranges):
+            blocks = [block.get('values', [])]
+            expected = TABLE_LAYOUTS[table]
+
+            if table in incremental:
+                df = self._extend_reservas(incremental[table], blocks, [len(expected)])
+                if df is None:
+                    log_booking_attempt("INCREMENTAL_SYNC_RESET", f"{table} changed above the watermark")
+                    reload.append(table)
+                else:
+                    result[table] = df
+                continue
+
+            rows = _block_rows(blocks)
+            df = _frame_from_rows(rows)
+            if df is None:
+                df = pd.DataFrame(columns=expected)
+            elif list(df.columns) != expected:
+                log_booking_attempt("BATCH_READ_LAYOUT", f"{table} header {list(df.columns)}, reading full sheet")
+                df = self._load_tables_individually([table])[table]
+                rows = []
+            if table == CREDENCIAL_TABLE:
+                df = df.astype(str)
+            if table == RESERVAS_TABLE and rows:
+                # Watermark for the next incremental sync
+                df.attrs.update(sheet_rows=len(rows), last_row=rows[-1], full_loaded_at=time.time())
+            result[table] = df
+
+        if reload:
+            result.update(self.load_tables(reload))
+        return result
+
+    def _can_extend(self, basis):
+        if basis is None or not basis.attrs.get('sheet_rows') or list(basis.columns) != RESERVAS_COLUMNS:
+            return False
+        # Periodic full reload also catches edits to rows other than the last one
+        return time.time() - basis.attrs.get('full_loaded_at', 0) < RESERVAS_FULL_RELOAD
+
+    def _extend_reservas(self, basis, blocks, widths):
+        """basis + rows appended after its last row, or None if that last row changed"""
+        rows = _block_rows(blocks, widths)
+        if not rows or rows[0] != basis.attrs['last_row']:
+            return None
+        # rows[0] is sheet row sheet_rows; the index keeps sheet row numbers
+        numbered = [(number, row) for number, row in enumerate(rows[1:], start=basis.attrs['sheet_rows'] + 1)
+                    if any(str(cell).strip() for cell in row)]
+        new_rows = [row for _, row in numbered]
+        if new_rows:
+            df = pd.concat([basis, pd.DataFrame(new_rows, columns=basis.columns,
+                                                index=[number for number, _ in numbered])])
+        else:
+            df = basis.copy(deep=False)
+        df.attrs = {
+            'sheet_rows': basis.attrs['sheet_rows'] + len(rows) - 1,
+            'last_row': rows[-1],
+            'full_loaded_at': basis.attrs['full_loaded_at'],
+            # Lets get_occupancy_index extend the previous index instead of rebuilding
+            'parent_snapshot': basis.attrs.get('snapshot_id'),
+            'parent_rows': len(basis),
+        }
+        log_booking_attempt("INCREMENTAL_SYNC", f"{len(new_rows)} new reservation row(s)")
+        return df
+
+    def _load_tables_individually(self, tables):
+        loaders = {
+            CREDENCIAL_TABLE: self.load_credentials,
+            RESERVAS_TABLE: self.load_reservas,
+            GESTION_TABLE: self.load_gestion,
+        }
+        return {table: loaders[table]() for table in tables}
+
+    def append_reserva(self, booking):
+        if SHEETS_WRITE_MODE == "legacy":
+            return self._append_reserva_legacy(booking)
+
+        booking_id = f"{booking['Proveedor']}_{booking['Fecha']}_{booking['Hora']}"
+        reservas_ws = self.handles.worksheet(RESERVAS_TABLE)
+        new_row_data = booking_row(booking)
+
+        # One append call; the API reports the exact range it wrote
+        try:
+            # Not idempotent: retried only if the request was rejected (429)
+            response = SHEETS_RETRY.run("append_row", lambda: reservas_ws.append_row(
+                new_row_data,
+                value_input_option='RAW',
+                insert_data_option='INSERT_ROWS',
+                table_range=f"A1:{_column_letter(len(RESERVAS_COLUMNS) - 1)}1"
+            ), idempotent=False)
+        except Exception as e:
+            self.handles.invalidate()
+            raise StorageError("2", f"API_FAILURE: append failed: {str(e)}", applied=False if write_rejected(e) else None)
+
+        updated_range = response.get('updates', {}).get('updatedRange', '')
+        log_booking_attempt("APPEND_REQUESTED", f"Appended {updated_range} for {booking_id}")
+        if not updated_range:
+            raise StorageError("4", "BOOKING_VERIFICATION_FAILED: append returned no range")
+
+        # Confirm only the range that was written
+        a1_range = updated_range.split('!')[-1]
+        try:
+            written = SHEETS_RETRY.run("get", lambda: reservas_ws.get(a1_range, value_render_option='UNFORMATTED_VALUE'))
+        except Exception as e:
+            raise StorageError("2", f"API_FAILURE: confirmation read failed: {str(e)}")
+        written_row = [str(value) for value in written[0]] if written else []
+        # Sheets drops trailing empty cells (an active booking's Estado)
+        written_row += [''] * (len(new_row_data) - len(written_row))
+        if written_row[:len(new_row_data)] != new_row_data:
+            raise StorageError("4", f"BOOKING_VERIFICATION_FAILED: {a1_range} contains {written_row}")
+
+        log_booking_attempt("BOOKING_SAVE_SUCCESS", f"{booking_id} saved and verified at {a1_range}", success=True)
+        return f"Booking saved and verified at {a1_range}"
+
+    def _append_reserva_legacy(self, booking):
+        """Previous write path: full-sheet reads, fixed waits and re-download verification"""
+        booking_id = f"{booking['Proveedor']}_{booking['Fecha']}_{booking['Hora']}"
+        spreadsheet = self.handles.spreadsheet()
+        reservas_ws = self.handles.worksheet(RESERVAS_TABLE)
+
+        log_booking_attempt("WORKSHEET_ACCESSED", "proveedor_reservas worksheet accessed")
+
+        # Final availability check of the assigned dock against the sheet itself
+        fecha_dia = booking['Fecha'].split(' ')[0]
+        dock_masks = self.dock_masks(fecha_dia)
+        dock = booking.get('Anden') or assign_dock(dock_masks, booking['Hora'])
+        if dock is None or dock_masks[dock - 1] & occupancy_mask([booking['Hora']]):
+            raise SlotTakenError("Slot already booked by another provider")
+        booking['Anden'] = dock
+
+        # Get initial row count BEFORE saving
+        initial_row_count = get_sheet_row_count(reservas_ws)
+        if initial_row_count == -1:
+            raise StorageError("2", "Failed to get initial row count", applied=False)
+
+        log_booking_attempt("INITIAL_ROW_COUNT", f"Rows before save: {initial_row_count}")
+
+        new_row_data = booking_row(booking)
+        log_booking_attempt("DATA_PREPARED", f"Row data: {new_row_data}")
+
+        # One write to the next free row; retries and waits are bounded by SHEETS_RETRY
+        try:
+            all_values = SHEETS_RETRY.run("get_all_values", reservas_ws.get_all_values)
+            next_row = len(all_values) + 1
+            col_range = f'A{next_row}:{_column_letter(len(RESERVAS_COLUMNS) - 1)}{next_row}'
+            SHEETS_RETRY.run("update", lambda: reservas_ws.update(
+                range_name=col_range,
+                values=[new_row_data],
+                value_input_option='RAW'
+            ))
+        except Exception as save_error:
+            raise StorageError("2", f"API_FAILURE: Save failed: {str(save_error)}")
+        log_booking_attempt("APPEND_REQUESTED", f"Updated row {next_row} for {booking_id}")
+
+        # Verify the specific booking was saved (CONTENT-ONLY VALIDATION)
+        verification_success, verification_message = verify_booking_saved(spreadsheet, booking)
+        if verification_success:
+            log_booking_attempt("BOOKING_SAVE_SUCCESS", f"{booking_id} successfully saved and verified", success=True)
+            return "Booking saved and verified successfully"
+
+        log_booking_attempt("BOOKING_VERIFICATION_FAILED", f"{booking_id} save failed - content not found: {verification_message}", success=False)
+        raise StorageError("4", f"BOOKING_VERIFICATION_FAILED: {verification_message}")
+
+    def _checked_row_range(self, row_number, current):
+        """(worksheet, A1 range) of a reservas row after confirming it still holds `current`"""
+        reservas_ws = self.handles.worksheet(RESERVAS_TABLE)
+        a1_range = f"A{row_number}:{_column_letter(len(RESERVAS_COLUMNS) - 1)}{row_number}"
+        try:
+            stored = SHEETS_RETRY.run("get", lambda: reservas_ws.get(a1_range))
+        except Exception as e:
+            self.handles.invalidate()
+            raise StorageError("2", f"API_FAILURE: row read failed: {str(e)}")
+        stored_row = [str(value) for value in stored[0]] if stored else []
+        expected = booking_row(current)[:5]
+        estado = RESERVAS_COLUMNS.index('Estado')
+        if stored_row[:5] != expected or (len(stored_row) > estado and stored_row[estado] == ESTADO_CANCELADA):
+            raise BookingNotFoundError(f"{a1_range} contains {stored_row}, expected {expected}")
+        return reservas_ws, a1_range
+
+    def cancel_reserva(self, row_key, current):
+        reservas_ws, _ = self._checked_row_range(row_key, current)
+        # Only the Estado cell changes: rows never shift, so row keys and the
+        # incremental-sync watermark stay valid
+        estado_cell = f"{_column_letter(RESERVAS_COLUMNS.index('Estado'))}{row_key}"
+        try:
+            SHEETS_RETRY.run("update", lambda: reservas_ws.update(
+                range_name=estado_cell, values=[[ESTADO_CANCELADA]], value_input_option='RAW'
+            ))
+        except Exception as e:
+            raise StorageError("2", f"API_FAILURE: cancel failed: {str(e)}")
+        log_booking_attempt("BOOKING_CANCELLED", f"Marked {estado_cell} {ESTADO_CANCELADA}", success=True)
+        return f"Booking cancelled at {estado_cell}"
+
+    def update_reserva(self, row_key, current, booking):
+        reservas_ws, a1_range = self._checked_row_range(row_key, current)
+        try:
+            SHEETS_RETRY.run("update", lambda: reservas_ws.update(
+                range_name=a1_range, values=[booking_row(booking)], value_input_option='RAW'
+            ))
+        except Exception as e:
+            raise StorageError("2", f"API_FAILURE: update failed: {str(e)}")
+        log_booking_attempt("BOOKING_RESCHEDULED", f"Rewrote {a1_range}", success=True)
+        return f"Booking updated at {a1_range}"
+
+    def append_rows(self, title, rows):
+        """Plain append used when Sheets is only an exported mirror"""
+        worksheet = self.handles.worksheet(title)
+        SHEETS_RETRY.run("append_rows", lambda: worksheet.append_rows(rows, value_input_option='RAW'), idempotent=False)
+
+    def replace_reserva_row(self, current, row):
+        """Mirror export: overwrite the active row holding `current` (matched on its first five columns).
+
+        The mirror has no row ids, so the row is found by content, newest first.
+        """
+        worksheet = self.handles.worksheet(RESERVAS_TABLE)
+        values = SHEETS_RETRY.run("get_all_values", worksheet.get_all_values)
+        expected = booking_row(current)[:5]
+        estado = RESERVAS_COLUMNS.index('Estado')
+        for number in range(len(values), 1, -1):
+            stored = [str(value) for value in values[number - 1]]
+            if stored[:5] == expected and (len(stored) <= estado or stored[estado] != ESTADO_CANCELADA):
+                a1_range = f"A{number}:{_column_letter(len(RESERVAS_COLUMNS) - 1)}{number}"
+                SHEETS_RETRY.run("update", lambda: worksheet.update(
+                    range_name=a1_range, values=[row], value_input_option='RAW'
+                ))
+                return a1_range
+        raise BookingNotFoundError(f"No mirror row holds {expected}")
+
+
+# SQL condition for rows that are not cancelled
+ACTIVE_RESERVA = f"COALESCE(Estado, '') != '{ESTADO_CANCELADA}'"
+# fecha_dia + RESERVAS_COLUMNS
+RESERVAS_PLACEHOLDERS = ', '.join('?' for _ in range(len(RESERVAS_COLUMNS) + 1))
+
+
+class SQLiteStorage(BookingStorage):
+    """Local transactional backend; bookings are one indexed insert.
+
+    When a Sheets `mirror` is given, empty tables are seeded from it on first
+    use and every booking, cancellation and reschedule is exported to it in
+    the background, in commit order. Staff keep maintaining credentials and
+    gestion in the sheet, so with a mirror those two tables are always read
+    from it; the local copy is refreshed on each read and only used while
+    Sheets is unreachable.
+    """
+
+    name = "sqlite"
+    atomic_commit = True
+
+    def __init__(self, path, mirror=None):
+        self.path = path
+        self.mirror = mirror
+        self.external_tables = frozenset((CREDENCIAL_TABLE, GESTION_TABLE)) if mirror else frozenset()
+        # One worker: a cancel is never exported before the append it refers to
+        self._mirror_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mirror") if mirror else None
+        self._init_schema()
+        if mirror is not None and self._is_empty():
+            self.import_from(mirror)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        try:
+            conn.executescript(f"""
+                CREATE TABLE IF NOT EXISTS {CREDENCIAL_TABLE} (
+                    usuario TEXT PRIMARY KEY, password TEXT, Email TEXT, cc TEXT
+                );
+                CREATE TABLE IF NOT EXISTS {RESERVAS_TABLE} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    fecha_dia TEXT NOT NULL,
+                    Fecha TEXT, Hora TEXT, Proveedor TEXT,
+                    Numero_de_bultos INTEGER, Orden_de_compra TEXT, Anden INTEGER,
+                    Estado TEXT DEFAULT ''
+                );
+                CREATE INDEX IF NOT EXISTS idx_reservas_fecha_dia ON {RESERVAS_TABLE} (fecha_dia);
+                CREATE TABLE IF NOT EXISTS {GESTION_TABLE} (
+                    {', '.join(f'{col} TEXT' for col in GESTION_COLUMNS)}
+                );
+            """)
+            # Databases created before dock assignment: existing rows are on dock 1
+            reservas_columns = [row[1] for row in conn.execute(f"PRAGMA table_info({RESERVAS_TABLE})")]
+            if 'Anden' not in reservas_columns:
+                conn.execute(f"ALTER TABLE {RESERVAS_TABLE} ADD COLUMN Anden INTEGER DEFAULT 1")
+            if 'Estado' not in reservas_columns:
+                conn.execute(f"ALTER TABLE {RESERVAS_TABLE} ADD COLUMN Estado TEXT DEFAULT ''")
+        finally:
+            conn.close()
+
+    def version_token(self):
+        # Commits land in the -wal file first, so both mtimes are part of the token
+        token = []
+        for path in (self.path, self.path + "-wal"):
+            try:
+                token.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                token.append(None)
+        return tuple(token)
+
+    def _is_empty(self):
+        conn = self._connect()
+        try:
+            return conn.execute(f"SELECT COUNT(*) FROM {CREDENCIAL_TABLE}").fetchone()[0] == 0
+        finally:
+            conn.close()
+
+    def _read_table(self, title, columns):
+        conn = self._connect()
+        try:
+            if title == RESERVAS_TABLE:
+                # Index = row id, used to locate bookings for cancel / reschedule
+                rows = conn.execute(f"SELECT id, {', '.join(columns)} FROM {title} ORDER BY id").fetchall()
+                return pd.DataFrame([row[1:] for row in rows], columns=columns, index=[row[0] for row in rows])
+            rows = conn.execute(f"SELECT {', '.join(columns)} FROM {title}").fetchall()
+        finally:
+            conn.close()
+        return pd.DataFrame(rows, columns=columns)
+
+    def _read_mirrored(self, title, columns, load):
+        """`title` from the Sheets mirror, refreshing the local copy; the local copy if Sheets fails"""
+        try:
+            df = load().reindex(columns=columns).fillna('').astype(str)
+        except Exception as e:
+            log_booking_attempt("MIRROR_READ_FAILED", f"{title}, using the local copy", error=str(e))
+            return self._read_table(title, columns)
+        rows = df.values.tolist()
+        local = self._read_table(title, columns).fillna('').astype(str).values.tolist()
+        if rows != local:
+            # Only on change: a write moves version_token() and would expire the reservas snapshot
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(f"DELETE FROM {title}")
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO {title} VALUES ({', '.join('?' for _ in columns)})", rows
+                )
+                conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                log_booking_attempt("MIRROR_COPY_FAILED", title, error=str(e))
+            finally:
+                conn.close()
+        return df
+
+    def load_credentials(self):
+        if self.mirror is not None:
+            return self._read_mirrored(CREDENCIAL_TABLE, CREDENCIAL_COLUMNS, self.mirror.load_credentials)
+        credentials_df = self._read_table(CREDENCIAL_TABLE, CREDENCIAL_COLUMNS)
+        for col in credentials_df.columns:
+            credentials_df[col] = credentials_df[col].astype(str)
+        return credentials_df
+
+    def load_reservas(self):
+        return self._read_table(RESERVAS_TABLE, RESERVAS_COLUMNS)
+
+    def load_gestion(self):
+        if self.mirror is not None:
+            return self._read_mirrored(GESTION_TABLE, GESTION_COLUMNS, self.mirror.load_gestion)
+        return self._read_table(GESTION_TABLE, GESTION_COLUMNS)
+
+    def dock_masks(self, fecha_dia):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT Hora, Anden FROM {RESERVAS_TABLE} WHERE fecha_dia = ? AND {ACTIVE_RESERVA}", (fecha_dia,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return build_dock_masks(rows)
+
+    def append_reserva(self, booking):
+        fecha_dia = booking['Fecha'].split(' ')[0]
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock so check + insert is atomic
+            conn.execute("BEGIN IMMEDIATE")
+            dock = assign_dock(build_dock_masks(conn.execute(
+                f"SELECT Hora, Anden FROM {RESERVAS_TABLE} WHERE fecha_dia = ? AND {ACTIVE_RESERVA}", (fecha_dia,)
+            )), booking['Hora'])
+            if dock is None:
+                conn.execute("ROLLBACK")
+                raise SlotTakenError("Slot already booked by another provider")
+            booking['Anden'] = dock
+            cursor = conn.execute(
+                f"INSERT INTO {RESERVAS_TABLE} (fecha_dia, {', '.join(RESERVAS_COLUMNS)}) VALUES ({RESERVAS_PLACEHOLDERS})",
+                [fecha_dia] + booking_row(booking)[:3] + [int(booking['Numero_de_bultos']), booking['Orden_de_compra'], dock, '']
+            )
+            conn.execute("COMMIT")
+            row_id = cursor.lastrowid
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise StorageError("2", f"SQLite write failed: {e}")
+        finally:
+            conn.close()
+
+        row = booking_row(booking)
+        self._mirror_async(f"append {booking['Fecha']} {booking['Hora']}",
+                           lambda: self.mirror.append_rows(RESERVAS_TABLE, [row]))
+        return f"Booking saved with id {row_id}"
+
+    def cancel_reserva(self, row_key, current):
+        conn = self._connect()
+        try:
+            # Marked like in Sheets, so the row and the mirror row stay put
+            cursor = conn.execute(
+                f"UPDATE {RESERVAS_TABLE} SET Estado = ? "
+                f"WHERE id = ? AND Fecha = ? AND Hora = ? AND Proveedor = ? AND {ACTIVE_RESERVA}",
+                (ESTADO_CANCELADA, int(row_key), current['Fecha'], current['Hora'], current['Proveedor'])
+            )
+        except sqlite3.Error as e:
+            raise StorageError("2", f"SQLite cancel failed: {e}")
+        finally:
+            conn.close()
+        if cursor.rowcount == 0:
+            raise BookingNotFoundError(f"Reservation {row_key} changed or no longer exists")
+        row = booking_row(dict(current, Estado=ESTADO_CANCELADA))
+        self._mirror_async(f"cancel {current['Fecha']} {current['Hora']}",
+                           lambda: self.mirror.replace_reserva_row(current, row))
+        return f"Booking {row_key} cancelled"
+
+    def update_reserva(self, row_key, current, booking):
+        fecha_dia = booking['Fecha'].split(' ')[0]
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            stored = conn.execute(
+                f"SELECT Fecha, Hora, Proveedor FROM {RESERVAS_TABLE} WHERE id = ? AND {ACTIVE_RESERVA}", (int(row_key),)
+            ).fetchone()
+            if stored is None or list(stored) != [current['Fecha'], current['Hora'], current['Proveedor']]:
+                conn.execute("ROLLBACK")
+                raise BookingNotFoundError(f"Reservation {row_key} changed or no longer exists")
+            # The booking's own row does not block its new slots
+            dock = assign_dock(build_dock_masks(conn.execute(
+                f"SELECT Hora, Anden FROM {RESERVAS_TABLE} WHERE fecha_dia = ? AND id != ? AND {ACTIVE_RESERVA}",
+                (fecha_dia, int(row_key))
+            )), booking['Hora'])
+            if dock is None:
+                conn.execute("ROLLBACK")
+                raise SlotTakenError("Slot already booked by another provider")
+            booking['Anden'] = dock
+            conn.execute(
+                f"UPDATE {RESERVAS_TABLE} SET fecha_dia = ?, Fecha = ?, Hora = ?, Anden = ? WHERE id = ?",
+                (fecha_dia, booking['Fecha'], booking['Hora'], dock, int(row_key))
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise StorageError("2", f"SQLite update failed: {e}")
+        finally:
+            conn.close()
+        row = booking_row(booking)
+        self._mirror_async(f"reschedule {current['Fecha']} {current['Hora']} -> {booking['Fecha']} {booking['Hora']}",
+                           lambda: self.mirror.replace_reserva_row(current, row))
+        return f"Booking {row_key} updated"
+
+    def _mirror_async(self, description, export):
+        """Queue export() on the mirror worker (no-op without a mirror)"""
+        if self._mirror_executor is None:
+            return
+        def run():
+            try:
+                # Staff read the mirror: wait for quota like a user read instead of being dropped
+                with sheets_priority(SHEETS_PRIORITY_NORMAL):
+                    export()
+                log_booking_attempt("MIRROR_EXPORTED", description)
+            except Exception as e:
+                log_booking_attempt("MIRROR_EXPORT_FAILED", description, error=str(e))
+        self._mirror_executor.submit(run)
+
+    def import_from(self, source):
+        """Replace local tables with the contents of another backend (e.g. first migration from Sheets)"""
+        credentials_df, reservas_df, gestion_df = source.load_all()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for title in (CREDENCIAL_TABLE, RESERVAS_TABLE, GESTION_TABLE):
+                conn.execute(f"DELETE FROM {title}")
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {CREDENCIAL_TABLE} VALUES (?, ?, ?, ?)",
+                credentials_df.reindex(columns=CREDENCIAL_COLUMNS).fillna('').astype(str).values.tolist()
+            )
+            conn.executemany(
+                f"INSERT INTO {RESERVAS_TABLE} (fecha_dia, {', '.join(RESERVAS_COLUMNS)}) VALUES ({RESERVAS_PLACEHOLDERS})",
+                [[str(row[0]).split(' ')[0]] + row
+                 for row in reservas_df.reindex(columns=RESERVAS_COLUMNS).fillna('').values.tolist()]
+            )
+            conn.executemany(
+                f"INSERT INTO {GESTION_TABLE} VALUES ({', '.join('?' for _ in GESTION_COLUMNS)})",
+                gestion_df.reindex(columns=GESTION_COLUMNS).fillna('').astype(str).values.tolist()
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        log_booking_attempt("SQLITE_IMPORT", f"Imported {len(reservas_df)} reservations from {source.name}")
+
+
+@st.cache_resource
+def get_storage():
+    """Return the configured storage backend (STORAGE_BACKEND = sheets | sqlite)"""
+    sheets = GoogleSheetsStorage()
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_PATH, mirror=sheets if SHEETS_MIRROR else None)
+    return sheets
+
+class BookingLedger:
+    """Compare-and-set claims on (date, dock, slot) triples.
+
+    Threads of this server serialize on per-slot locks; other server processes
+    serialize on the ledger file, where each slot of a dock can be claimed only once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS dock_claims (
+                    fecha_dia TEXT NOT NULL,
+                    dock INTEGER NOT NULL,
+                    slot INTEGER NOT NULL,
+                    booking_id TEXT NOT NULL,
+                    claimed_at REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (fecha_dia, dock, slot)
+                )
+            """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(dock_claims)")}
+            if 'claimed_at' not in columns:
+                conn.execute("ALTER TABLE dock_claims ADD COLUMN claimed_at REAL NOT NULL DEFAULT 0")
+            # Per-slot claims from before docks were tracked belong to dock 1 (like rows without Anden)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'slot_claims'").fetchone():
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("""
+                    INSERT OR IGNORE INTO dock_claims (fecha_dia, dock, slot, booking_id, claimed_at)
+                    SELECT fecha_dia, 1, slot, booking_id, 0 FROM slot_claims
+                """)
+                conn.execute("DROP TABLE slot_claims")
+                conn.execute("COMMIT")
+            # Claims for past days can no longer conflict
+            conn.execute("DELETE FROM dock_claims WHERE fecha_dia < ?", (datetime.now().strftime('%Y-%m-%d'),))
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _slot_lock(self, key):
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @contextlib.contextmanager
+    def hold(self, fecha_dia, slots):
+        """Hold the in-process locks of every slot (sorted, so overlapping bookings cannot deadlock)"""
+        locks = [self._slot_lock((fecha_dia, slot)) for slot in sorted(set(slots))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def claim(self, fecha_dia, dock, slots, booking_id):
+        """Atomically claim all slots of a dock or none. Raises SlotTakenError on conflict"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT INTO dock_claims (fecha_dia, dock, slot, booking_id, claimed_at) VALUES (?, ?, ?, ?, ?)",
+                    [(fecha_dia, dock, slot, booking_id, time.time()) for slot in slots]
+                )
+            except sqlite3.IntegrityError:
+                conn.execute("ROLLBACK")
+                raise SlotTakenError("Slot already claimed by another booking")
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def move(self, old, new):
+        """Swap the claims of `old` for those of `new` in one transaction.
+
+        Each is (fecha_dia, dock, slots, booking_id). Raises SlotTakenError if
+        a slot of `new` is claimed by another booking.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            fecha_dia, dock, slots, booking_id = old
+            conn.executemany(
+                "DELETE FROM dock_claims WHERE fecha_dia = ? AND dock = ? AND slot = ? AND booking_id = ?",
+                [(fecha_dia, dock, slot, booking_id) for slot in slots]
+            )
+            fecha_dia, dock, slots, booking_id = new
+            try:
+                conn.executemany(
+                    "INSERT INTO dock_claims (fecha_dia, dock, slot, booking_id, claimed_at) VALUES (?, ?, ?, ?, ?)",
+                    [(fecha_dia, dock, slot, booking_id, time.time()) for slot in slots]
+                )
+            except sqlite3.IntegrityError:
+                conn.execute("ROLLBACK")
+                raise SlotTakenError("Slot already claimed by another booking")
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def release(self, fecha_dia, dock, slots, booking_id):
+        """Drop claims held by booking_id (failed write)"""
+        conn = self._connect()
+        try:
+            conn.executemany(
+                "DELETE FROM dock_claims WHERE fecha_dia = ? AND dock = ? AND slot = ? AND booking_id = ?",
+                [(fecha_dia, dock, slot, booking_id) for slot in slots]
+            )
+        finally:
+            conn.close()
+
+    def reconcile(self, fecha_dia, is_live, claimed_before):
+        """Drop claims on fecha_dia made before `claimed_before` for which is_live(booking_id, dock) is False.
+
+        Returns the booking ids dropped.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            claims = conn.execute(
+                "SELECT DISTINCT booking_id, dock FROM dock_claims WHERE fecha_dia = ? AND claimed_at < ?",
+                (fecha_dia, claimed_before)
+            ).fetchall()
+            orphaned = [(booking_id, dock) for booking_id, dock in claims if not is_live(booking_id, dock)]
+            conn.executemany(
+                "DELETE FROM dock_claims WHERE fecha_dia = ? AND booking_id = ? AND dock = ?",
+                [(fecha_dia, booking_id, dock) for booking_id, dock in orphaned]
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return [booking_id for booking_id, _ in orphaned]
+
+
+@st.cache_resource
+def get_booking_ledger():
+    """Process-wide BookingLedger on LEDGER_PATH"""
+    return BookingLedger(LEDGER_PATH)
+
+def _final_dock_masks(fecha_dia, booking_id):
+    """Dock masks of fecha_dia from a snapshot at most FINAL_CHECK_MAX_AGE old.
+
+    Ledger claims the snapshot proves orphaned (row deleted by hand, failed
+    write) are dropped first. Without a recent snapshot the booking is
+    refused: the ledger alone cannot tell what the sheet holds.
+    """
+    try:
+        reservas_df = get_table_cache().get(RESERVAS_TABLE, max_age=FINAL_CHECK_MAX_AGE)
+    except Exception as e:
+        log_booking_attempt("FINAL_SNAPSHOT_FAILED", booking_id, error=str(e))
+        raise StorageError("1", f"FINAL_SNAPSHOT_FAILED: {str(e)}")
+
+    locator = get_row_locator(reservas_df)
+    def is_live(claim_id, dock):
+        # booking ids are "{Proveedor}_{Fecha}_{Hora}"; Fecha and Hora contain no '_'
+        proveedor, _, hora = claim_id.rsplit('_', 2)
+        return locator.locate(fecha_dia, hora.split(',')[0], dock, proveedor) is not None
+    claimed_before = time.time() - (snapshot_age(RESERVAS_TABLE) or 0) - LEDGER_CLAIM_GRACE
+    orphaned = get_booking_ledger().reconcile(fecha_dia, is_live, claimed_before)
+    if orphaned:
+        log_booking_attempt("LEDGER_RECONCILED", f"{fecha_dia}: dropped {', '.join(orphaned)}")
+    return get_occupancy_index(reservas_df).dock_masks(fecha_dia)
+
+def commit_booking(storage, booking):
+    """Compare-and-set commit for backends without their own transactions.
+
+    Under the slot locks, picks the first dock a recent snapshot shows free
+    for the whole booking, claims it in the ledger (falling through to the
+    next candidate dock if another process got there first), then writes.
+    The claim is released only if the write provably did not happen; after
+    an ambiguous failure (timeout, code 4) it stays until reconcile() finds
+    no row for it, LEDGER_CLAIM_GRACE later.
+    """
+    fecha_dia = booking['Fecha'].split(' ')[0]
+    slots = [slot_index(slot) for slot in parse_booked_slots([booking['Hora']])]
+    booking_id = f"{booking['Proveedor']}_{booking['Fecha']}_{booking['Hora']}"
+    ledger = get_booking_ledger()
+
+    with ledger.hold(fecha_dia, slots):
+        dock_masks = _final_dock_masks(fecha_dia, booking_id)
+        needed = slots_to_mask(slot_label(slot) for slot in slots)
+        candidates = [dock for dock, mask in enumerate(dock_masks, start=1) if not mask & needed]
+        if not candidates:
+            raise SlotTakenError("Slot already booked by another provider")
+
+        for dock in candidates:
+            try:
+                ledger.claim(fecha_dia, dock, slots, booking_id)
+                break
+            except SlotTakenError:
+                continue
+        else:
+            raise SlotTakenError("Slot already claimed by another booking")
+
+        booking['Anden'] = dock
         try:
-            credentials_ws = spreadsheet.worksheet("proveedor_credencial")
-            credentials_data = credentials_ws.get_all_records()
-            if credentials_data:
-                credentials_df = pd.DataFrame(credentials_data)
-                # Ensure all columns are strings for consistency
-                for col in credentials_df.columns:
-                    credentials_df[col] = credentials_df[col].astype(str)
+            return storage.append_reserva(booking)
+        except Exception as e:
+            if write_rejected(e):
+                ledger.release(fecha_dia, dock, slots, booking_id)
             else:
-                # Fallback to raw values
-                all_values = credentials_ws.get_all_values()
-                if all_values and len(all_values) > 1:
-                    credentials_df = pd.DataFrame(all_values[1:], columns=all_values[0])
-                else:
-                    credentials_df = pd.DataFrame(columns=['usuario', 'password', 'Email', 'cc'])
-        except gspread.WorksheetNotFound:
-            credentials_df = pd.DataFrame(columns=['usuario', 'password', 'Email', 'cc'])
-        
-        # Load reservas sheet
-        try:
-            reservas_ws = spreadsheet.worksheet("proveedor_reservas")
-            reservas_data = reservas_ws.get_all_records()
-            if reservas_data:
-                reservas_df = pd.DataFrame(reservas_data)
+                log_booking_attempt("LEDGER_CLAIM_KEPT", f"{booking_id} on dock {dock}: write outcome unknown")
+            raise
+
+
+def _booking_claim(booking, dock=None):
+    """(fecha_dia, dock, slot indexes, booking_id) of a booking, as held in the ledger"""
+    fecha_dia = booking['Fecha'].split(' ')[0]
+    slots = [slot_index(slot) for slot in parse_booked_slots([booking['Hora']])]
+    booking_id = f"{booking['Proveedor']}_{booking['Fecha']}_{booking['Hora']}"
+    return fecha_dia, dock if dock is not None else parse_anden(booking.get('Anden')), slots, booking_id
+
+def _edited_reservas(row_key, booking):
+    """TableCache.apply update: replace the row at row_key with `booking`"""
+    def update(reservas_df):
+        # object dtype: the written values are strings (SQLite snapshots hold ints)
+        df = reservas_df.astype(object)
+        values = dict(zip(RESERVAS_COLUMNS, booking_row(booking)))
+        df.loc[row_key] = [values.get(col, '') for col in df.columns]
+        # Same incremental-sync watermark; the edited row may be the anchor
+        df.attrs = {key: value for key, value in reservas_df.attrs.items()
+                    if key in ('sheet_rows', 'last_row', 'full_loaded_at')}
+        if df.attrs.get('sheet_rows') == row_key:
+            df.attrs['last_row'] = booking_row(booking)
+        return df
+    return update
+
+@sheets_priority(SHEETS_PRIORITY_HIGH)
+def cancel_booking(storage, row_key, current):
+    """Cancel a booking and show its slots as free right away (no reload)"""
+    message = storage.cancel_reserva(row_key, current)
+    if not storage.atomic_commit:
+        get_booking_ledger().release(*_booking_claim(current))
+    get_table_cache().apply(RESERVAS_TABLE, _edited_reservas(row_key, dict(current, Estado=ESTADO_CANCELADA)))
+    return message
+
+@sheets_priority(SHEETS_PRIORITY_HIGH)
+def reschedule_booking(storage, row_key, current, booking):
+    """Move a booking to booking['Fecha'] / booking['Hora'] by rewriting its row.
+
+    Without a transactional backend the new slots go through the ledger like
+    commit_booking; the booking's own slots do not count as taken.
+    """
+    if storage.atomic_commit:
+        message = storage.update_reserva(row_key, current, booking)
+    else:
+        old_claim = _booking_claim(current)
+        fecha_dia, _, slots, booking_id = _booking_claim(booking, dock=0)
+        ledger = get_booking_ledger()
+        with ledger.hold(fecha_dia, slots):
+            dock_masks = _final_dock_masks(fecha_dia, booking_id)
+            old_fecha, old_dock, old_slots, _ = old_claim
+            if old_fecha == fecha_dia and old_dock <= DOCK_COUNT:
+                dock_masks[old_dock - 1] &= ~slots_to_mask(slot_label(slot) for slot in old_slots)
+            needed = slots_to_mask(slot_label(slot) for slot in slots)
+            candidates = [dock for dock, mask in enumerate(dock_masks, start=1) if not mask & needed]
+
+            for dock in candidates:
+                try:
+                    ledger.move(old_claim, (fecha_dia, dock, slots, booking_id))
+                    break
+                except SlotTakenError:
+                    continue
             else:
-                # Fallback to raw values
-                all_values = reservas_ws.get_all_values()
-                if all_values and len(all_values) > 1:
-                    reservas_df = pd.DataFrame(all_values[1:], columns=all_values[0])
+                raise SlotTakenError("Slot already booked by another provider")
+
+            booking['Anden'] = dock
+            new_claim = (fecha_dia, dock, slots, booking_id)
+            try:
+                message = storage.update_reserva(row_key, current, booking)
+            except Exception as e:
+                # The row still holds the old slots (or may, if the outcome is
+                # unknown): take them back. On an ambiguous failure the new
+                # claim stays too and reconcile drops whichever one is stale.
+                try:
+                    if write_rejected(e):
+                        ledger.move(new_claim, old_claim)
+                    else:
+                        log_booking_attempt("LEDGER_CLAIM_KEPT", f"{booking_id} on dock {dock}: write outcome unknown")
+                        ledger.claim(*old_claim)
+                except SlotTakenError:
+                    log_booking_attempt("LEDGER_RESTORE_FAILED", f"{booking_id} on dock {old_claim[1]}: old slots claimed by another booking")
+                raise
+    get_table_cache().apply(RESERVAS_TABLE, _edited_reservas(row_key, booking))
+    return message
+
+
+class TableCache:
+    """Per-table cache with its own TTL.
+
+    Concurrent misses on the same table share one fetch (single-flight), and
+    invalidation only drops the table that changed. With a SharedTableStore,
+    other server processes see invalidations at once and reuse each other's
+    downloads.
+    """
+
+    def __init__(self, loader, ttls, version_probe=None, post_load=None, persist=None, shared=None, unversioned=()):
+        self._loader = loader    # callable: ([tables], {table: previous}) -> {table: DataFrame}, one round trip
+        self._post_load = post_load  # callable: (table, DataFrame), runs once per new snapshot
+        self._persist = persist  # callable: (table, DataFrame, version), e.g. SnapshotStore.update
+        self._shared = shared    # SharedTableStore, or None for a process-local cache
+        self._ttls = ttls        # table -> seconds
+        self._version_probe = version_probe  # cheap callable -> data version token (or None)
+        self._unversioned = frozenset(unversioned)  # tables the probe does not cover: always reloaded on expiry
+        self._entries = {}       # table -> (DataFrame, loaded_at, version)
+        self._basis = {}         # table -> last snapshot, kept after invalidation for incremental loads
+        self._inflight = {}      # table -> Future of the running fetch
+        self._warm = set()       # tables still holding a snapshot from disk (see warm_start)
+        self._shared_gen = {}    # table -> shared generation the cached entry belongs to
+        self._generation = {table: 0 for table in ttls}
+        self._lock = threading.Lock()
+
+    def get(self, table, max_age=None):
+        """Cached table if younger than max_age (default: the table TTL), else fetch"""
+        result, missing = self._lookup([table], max_age)
+        if missing:
+            result.update(self._fetch_or_stale(missing, allow_stale=max_age is None))
+        return result[table]
+
+    def get_many(self, tables):
+        """{table: DataFrame}; every expired table is fetched in the same batch"""
+        result, missing = self._lookup(tables)
+        if missing:
+            result.update(self._fetch_or_stale(missing, allow_stale=True))
+        return result
+
+    def _fetch_or_stale(self, tables, allow_stale):
+        """Fetch; out of quota or with the backend down, fall back to the expired
+        snapshots if every table has one.
+
+        Callers that asked for an explicit max_age (final checks) never get stale data.
+        """
+        try:
+            return self._fetch_many(tables)
+        except (QuotaExhaustedError, CircuitOpenError) as e:
+            with self._lock:
+                stale = {table: self._entries[table][0] for table in tables if table in self._entries}
+            if not allow_stale or len(stale) < len(tables):
+                raise
+            log_booking_attempt("STALE_SERVED", ", ".join(tables), error=str(e))
+            return stale
+
+    def _probe(self):
+        if self._version_probe is None:
+            return None
+        try:
+            return self._version_probe()
+        except Exception as e:
+            log_booking_attempt("VERSION_PROBE_FAILED", "", error=str(e))
+            return None
+
+    def _lookup(self, tables, max_age=None):
+        """Split tables into (fresh {table: DataFrame}, [tables to fetch]).
+
+        An entry invalidated by another process counts as expired. Expired
+        tables are taken from the shared store if another process published
+        a recent enough copy; the rest are renewed instead of refetched when
+        their recorded version still matches the probe.
+        """
+        limits = {table: self._ttls[table] if max_age is None else max_age for table in tables}
+        shared_gen = self._shared.generations(tables) if self._shared is not None else {}
+        now = time.monotonic()
+        result, expired = {}, []
+        with self._lock:
+            for table in tables:
+                entry = self._entries.get(table)
+                current = self._shared_gen.get(table) == shared_gen.get(table)
+                # A disk snapshot serves default reads until the first refresh replaces it
+                if entry is not None and ((current and now - entry[1] <= limits[table])
+                                          or (max_age is None and table in self._warm)):
+                    result[table] = entry[0]
                 else:
-                    reservas_df = pd.DataFrame(columns=['Fecha', 'Hora', 'Proveedor', 'Numero_de_bultos', 'Orden_de_compra'])
-        except gspread.WorksheetNotFound:
-            reservas_df = pd.DataFrame(columns=['Fecha', 'Hora', 'Proveedor', 'Numero_de_bultos', 'Orden_de_compra'])
-        
-        # Load or create gestion sheet
+                    expired.append(table)
+        if not expired:
+            return result, []
+
+        if self._shared is not None:
+            for table in list(expired):
+                hit = self._shared.read(table, shared_gen[table], max_age=limits[table])
+                if hit is not None:
+                    result[table] = self._install(table, *hit, shared_gen[table])
+                    expired.remove(table)
+            if not expired:
+                return result, []
+
+        version = self._probe() if any(table in self._entries for table in expired) else None
+        missing = []
+        with self._lock:
+            for table in expired:
+                entry = self._entries.get(table)
+                if (version is not None and entry is not None and entry[2] == version
+                        and self._shared_gen.get(table) == shared_gen.get(table)):
+                    self._entries[table] = (entry[0], time.monotonic(), version)
+                    self._warm.discard(table)
+                    result[table] = entry[0]
+                else:
+                    missing.append(table)
+        return result, missing
+
+    def _install(self, table, df, age, version, shared_generation):
+        """Cache a snapshot adopted from the shared store; returns it"""
+        df.attrs['snapshot_id'] = time.time_ns()
+        with self._lock:
+            self._entries[table] = (df, time.monotonic() - age, version)
+            self._basis[table] = df
+            self._warm.discard(table)
+            self._shared_gen[table] = shared_generation
+        if self._post_load is not None:
+            try:
+                self._post_load(table, df)
+            except Exception as e:
+                log_booking_attempt("POST_LOAD_FAILED", table, error=str(e))
+        return df
+
+    def age(self, table):
+        """Seconds since the cached snapshot was loaded (None if not cached)"""
+        with self._lock:
+            entry = self._entries.get(table)
+        return None if entry is None else time.monotonic() - entry[1]
+
+    def _fetch_many(self, tables):
+        # Lead the fetch of tables nobody is loading yet, wait on the others
+        futures, led = {}, []
+        with self._lock:
+            for table in tables:
+                future = self._inflight.get(table)
+                if future is None:
+                    future = Future()
+                    self._inflight[table] = future
+                    led.append((table, future, self._generation[table]))
+                futures[table] = future
+
+        if led:
+            try:
+                # Version read before the load, so a change during the load is caught next time
+                version = self._probe()
+                with self._lock:
+                    previous = {table: self._basis[table] for table, _, _ in led if table in self._basis}
+                loaded = self._load([table for table, _, _ in led], previous, version)
+            except Exception as e:
+                with self._lock:
+                    for table, _, _ in led:
+                        self._inflight.pop(table, None)
+                for _, future, _ in led:
+                    future.set_exception(e)
+                raise
+
+            stamp = time.monotonic()
+            stored = set()
+            with self._lock:
+                for table, _, generation in led:
+                    df, age, table_version, shared_generation = loaded[table]
+                    # Derived structures (occupancy index) are cached per snapshot
+                    df.attrs['snapshot_id'] = time.time_ns()
+                    self._inflight.pop(table, None)
+                    # Don't store a fetch that started before an invalidation
+                    if self._generation[table] == generation:
+                        self._entries[table] = (df, stamp - age, None if table in self._unversioned else table_version)
+                        self._basis[table] = df
+                        self._warm.discard(table)
+                        self._shared_gen[table] = shared_generation
+                        stored.add(table)
+            for table, future, _ in led:
+                df, _, table_version, _ = loaded[table]
+                if self._post_load is not None:
+                    try:
+                        self._post_load(table, df)
+                    except Exception as e:
+                        log_booking_attempt("POST_LOAD_FAILED", table, error=str(e))
+                if self._persist is not None and table in stored:
+                    self._persist(table, df, table_version)
+                future.set_result(df)
+
+        return {table: future.result() for table, future in futures.items()}
+
+    def _load(self, tables, previous, version):
+        """{table: (DataFrame, age, version, shared generation)} for the tables this process leads.
+
+        With a shared store, a copy another process published for the probed
+        data version is reused, and a table another process is downloading is
+        awaited (up to its lease) instead of downloaded twice. What this
+        process downloads is published for the others.
+        """
+        if self._shared is None:
+            values = self._loader(tables, previous)
+            return {table: (values[table], 0.0, version, None) for table in tables}
+
+        generations = self._shared.generations(tables)
+        loaded, pending = {}, []
+        for table in tables:
+            hit = self._shared.read(table, generations[table], version=version) if version is not None else None
+            if hit is not None:
+                loaded[table] = (*hit, generations[table])
+            else:
+                pending.append(table)
+
+        leased = [table for table in pending if self._shared.try_lease(table)]
         try:
-            gestion_ws = spreadsheet.worksheet("proveedor_gestion")
-            gestion_data = gestion_ws.get_all_records()
-            if gestion_data:
-                gestion_df = pd.DataFrame(gestion_data)
+            waiting = [table for table in pending if table not in leased]
+            if waiting:
+                since = time.time()
+                give_up = time.monotonic() + self._shared.lease_seconds
+                while waiting and time.monotonic() < give_up:
+                    time.sleep(0.1)
+                    for table in list(waiting):
+                        hit = self._shared.read(table, generations[table], since=since)
+                        if hit is not None:
+                            loaded[table] = (*hit, generations[table])
+                            waiting.remove(table)
+            to_fetch = [table for table in pending if table not in loaded]
+            if to_fetch:
+                values = self._loader(to_fetch, {table: previous[table] for table in to_fetch if table in previous})
+                for table in to_fetch:
+                    self._shared.publish(table, values[table], version, generations[table])
+                    loaded[table] = (values[table], 0.0, version, generations[table])
+        finally:
+            for table in leased:
+                self._shared.release(table)
+        return loaded
+
+    def start_refresher(self, table, interval):
+        """Background thread that refreshes `table` every `interval` seconds.
+
+        With interval < TTL the snapshot is replaced before it expires, so
+        readers never wait on a download (stale-while-revalidate). A copy
+        another process refreshed within the last half interval is reused.
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                with sheets_priority(SHEETS_PRIORITY_BACKGROUND):
+                    self.revalidate(table, max_age=interval / 2)
+
+        threading.Thread(target=run, name=f"refresh-{table}", daemon=True).start()
+
+    def revalidate(self, *tables, max_age=0):
+        """A version probe, and a download only if the data changed; failures are logged"""
+        for table in tables:
+            try:
+                self.get(table, max_age=max_age)
+            except Exception as e:
+                log_booking_attempt("BACKGROUND_REFRESH_FAILED", table, error=str(e))
+
+    def warm_start(self, snapshots):
+        """Install {table: (DataFrame, age seconds, version)} read from disk; returns the tables installed.
+
+        They keep their real age, so reads with an explicit max_age (final
+        checks) still fetch, but default reads are served from them until
+        revalidate() replaces them.
+        """
+        installed = []
+        now = time.monotonic()
+        with self._lock:
+            for table, (df, age, version) in snapshots.items():
+                if table not in self._ttls or table in self._entries:
+                    continue
+                df.attrs['snapshot_id'] = time.time_ns()
+                self._entries[table] = (df, now - age, version)
+                self._basis[table] = df
+                self._warm.add(table)
+                installed.append(table)
+        for table in installed:
+            if self._post_load is not None:
+                try:
+                    self._post_load(table, self._basis[table])
+                except Exception as e:
+                    log_booking_attempt("POST_LOAD_FAILED", table, error=str(e))
+        return installed
+
+    def apply(self, table, update):
+        """Install update(cached snapshot) as the fresh snapshot after a local write.
+
+        Shows the change without a reload; with nothing cached the table is
+        simply dropped. A fetch already in flight is discarded. Other
+        processes are invalidated and handed the edited snapshot.
+        """
+        with self._lock:
+            self._generation[table] += 1
+            entry = self._entries.pop(table, None)
+            if entry is None:
+                df = None
             else:
-                # Fallback to raw values
-                all_values = gestion_ws.get_all_values()
-                if all_values and len(all_values) > 1:
-                    gestion_df = pd.DataFrame(all_values[1:], columns=all_values[0])
-                else:
-                    gestion_df = pd.DataFrame(columns=[
-                        'Orden_de_compra', 'Proveedor', 'Numero_de_bultos',
-                        'Hora_llegada', 'Hora_inicio_atencion', 'Hora_fin_atencion',
-                        'Tiempo_espera', 'Tiempo_atencion', 'Tiempo_total', 'Tiempo_retraso',
-                        'numero_de_semana', 'hora_de_reserva'
-                    ])
-        except gspread.WorksheetNotFound:
-            # Create gestion sheet if it doesn't exist
+                df = update(entry[0])
+                df.attrs['snapshot_id'] = time.time_ns()
+                # No version recorded: the next expiry always revalidates
+                self._entries[table] = (df, time.monotonic(), None)
+                self._basis[table] = df
+            self._warm.discard(table)
+        if self._shared is not None:
+            generation = self._shared.bump([table])[table]
+            if df is not None:
+                self._shared.publish(table, df, None, generation)
+                with self._lock:
+                    if self._entries.get(table, (None,))[0] is df:
+                        self._shared_gen[table] = generation
+        if df is None:
+            return None
+        if self._post_load is not None:
             try:
-                gestion_ws = spreadsheet.add_worksheet("proveedor_gestion", rows=100, cols=12)
-                # Add headers
-                headers = [
-                    'Orden_de_compra', 'Proveedor', 'Numero_de_bultos',
-                    'Hora_llegada', 'Hora_inicio_atencion', 'Hora_fin_atencion',
-                    'Tiempo_espera', 'Tiempo_atencion', 'Tiempo_total', 'Tiempo_retraso',
-                    'numero_de_semana', 'hora_de_reserva'
-                ]
-                gestion_ws.update('A1:L1', [headers])
-                gestion_df = pd.DataFrame(columns=headers)
+                self._post_load(table, df)
             except Exception as e:
-                st.warning(f"No se pudo crear hoja de gestión: {e}")
-                gestion_df = pd.DataFrame(columns=[
-                    'Orden_de_compra', 'Proveedor', 'Numero_de_bultos',
-                    'Hora_llegada', 'Hora_inicio_atencion', 'Hora_fin_atencion',
-                    'Tiempo_espera', 'Tiempo_atencion', 'Tiempo_total', 'Tiempo_retraso',
-                    'numero_de_semana', 'hora_de_reserva'
-                ])
-        
-        return credentials_df, reservas_df, gestion_df
-        
+                log_booking_attempt("POST_LOAD_FAILED", table, error=str(e))
+        if self._persist is not None:
+            self._persist(table, df, None)
+        return df
+
+    def invalidate(self, *tables):
+        """Drop the given tables (all if none given) here and in the other processes, so the next get() refetches"""
+        tables = tables or list(self._ttls)
+        with self._lock:
+            for table in tables:
+                self._entries.pop(table, None)
+                self._warm.discard(table)
+                self._generation[table] += 1
+        if self._shared is not None:
+            self._shared.bump(tables)
+
+
+# Attrs the incremental reservas sync needs to continue from a stored snapshot
+SNAPSHOT_SYNC_ATTRS = ('sheet_rows', 'last_row', 'full_loaded_at')
+
+def _column_array(values):
+    """Column (or index) as a numpy array that loads without pickle: object columns become str"""
+    array = np.asarray(values)
+    if array.dtype.kind == 'O':
+        array = np.array(['' if value is None else str(value) for value in array], dtype=str)
+    return array
+
+def encode_frames(frames, **header):
+    """{table: (DataFrame, version)} -> compressed npz bytes, one array per column.
+
+    The JSON header holds `header` plus the columns, sync attrs and version of each table.
+    """
+    arrays, meta = {}, {}
+    for table, (df, version) in frames.items():
+        arrays[f"{table}/index"] = _column_array(df.index)
+        for i, column in enumerate(df.columns):
+            arrays[f"{table}/{i}"] = _column_array(df[column])
+        meta[table] = {
+            'columns': [str(column) for column in df.columns],
+            'attrs': {key: df.attrs[key] for key in SNAPSHOT_SYNC_ATTRS if key in df.attrs},
+            'version': version,
+        }
+    arrays['header'] = np.array(json.dumps(dict(header, tables=meta), default=str))
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    return buffer.getvalue()
+
+def decode_frames(payload):
+    """Inverse of encode_frames: (header, {table: (DataFrame, version)}); never unpickles"""
+    frames = {}
+    with np.load(io.BytesIO(payload), allow_pickle=False) as arrays:
+        header = json.loads(str(arrays['header']))
+        for table, meta in header['tables'].items():
+            df = pd.DataFrame(
+                {column: arrays[f"{table}/{i}"] for i, column in enumerate(meta['columns'])},
+                columns=meta['columns'], index=arrays[f"{table}/index"]
+            )
+            df.attrs.update(meta['attrs'])
+            version = meta['version']
+            # JSON turned the version tuple into a list
+            frames[table] = (df, tuple(version) if isinstance(version, list) else version)
+    return header, frames
+
+
+class SnapshotStore:
+    """Last good dataset on disk, so a restarted server renders before Sheets answers.
+
+    File layout: a magic/format line, the sha256 of the payload, then an
+    encode_frames payload that also records the column layout. Files with a
+    bad checksum, another format or another column layout are ignored.
+    Writes are coalesced in a background thread and replace the file atomically.
+    """
+
+    MAGIC = b"ALMACEN-SNAPSHOT/1"
+
+    def __init__(self, path, layouts, write_delay=2.0):
+        self.path = path
+        self.layouts = {table: list(columns) for table, columns in layouts.items()}
+        self.write_delay = write_delay  # seconds to gather several table updates into one write
+        self._tables = {}  # table -> (DataFrame, version)
+        self._dirty = threading.Event()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """{table: (DataFrame, age seconds, version)} from disk; {} if missing or invalid"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            log_booking_attempt("SNAPSHOT_READ_FAILED", self.path, error=str(e))
+            return {}
+        try:
+            magic, digest, payload = data.split(b"\n", 2)
+            if magic != self.MAGIC:
+                raise ValueError(f"unknown format {magic[:40]!r}")
+            if not hmac.compare_digest(digest, hashlib.sha256(payload).hexdigest().encode()):
+                raise ValueError("checksum mismatch")
+            header, frames = decode_frames(payload)
+            if header['layouts'] != self.layouts:
+                raise ValueError("column layout changed")
+            age = max(0.0, time.time() - header['saved_at'])
+        except Exception as e:
+            log_booking_attempt("SNAPSHOT_INVALID", self.path, error=str(e))
+            return {}
+        with self._lock:
+            for table, frame in frames.items():
+                self._tables.setdefault(table, frame)
+        log_booking_attempt("SNAPSHOT_LOADED", f"{', '.join(frames)} ({age:.0f} s old)")
+        return {table: (df, age, version) for table, (df, version) in frames.items()}
+
+    def update(self, table, df, version):
+        """Record a new good snapshot of `table`; written to disk shortly after.
+
+        Tables without a layout (credentials) are never written.
+        """
+        if table not in self.layouts:
+            return
+        with self._lock:
+            self._tables[table] = (df, version)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="snapshot-writer", daemon=True)
+                self._writer.start()
+        self._dirty.set()
+
+    def _write_loop(self):
+        while True:
+            self._dirty.wait()
+            time.sleep(self.write_delay)
+            self._dirty.clear()
+            try:
+                self.save()
+            except Exception as e:
+                log_booking_attempt("SNAPSHOT_WRITE_FAILED", self.path, error=str(e))
+
+    def save(self):
+        """Write every recorded table now"""
+        with self._lock:
+            tables = dict(self._tables)
+        payload = encode_frames(tables, saved_at=time.time(), layouts=self.layouts)
+
+        # Owner-only file (provider bookings), swapped in atomically
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.MAGIC + b"\n" + hashlib.sha256(payload).hexdigest().encode() + b"\n" + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class SharedTableStore:
+    """Table snapshots and invalidations shared by the server processes of this host.
+
+    SQLite in WAL mode, so readers never block the writer. Every table has a
+    generation that invalidate()/apply() in any process bumps, and a
+    published snapshot is only served at the generation it was loaded
+    under. A lease lets one process download a table while the others wait
+    for its copy. Private tables (credentials) only share their generation:
+    their contents are never written, so every process downloads its own.
+    """
+
+    def __init__(self, path, lease_seconds=15, private=()):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.private = frozenset(private)
+        self._holder = f"{os.getpid()}"
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS generations (
+                    name TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    name TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    loaded_at REAL NOT NULL,
+                    version TEXT NOT NULL,
+                    payload BLOB NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def generations(self, tables):
+        """{table: current generation} (0 for a table never invalidated)"""
+        if not tables:
+            return {}
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT name, generation FROM generations WHERE name IN ({', '.join('?' for _ in tables)})",
+                list(tables)
+            ).fetchall()
+        finally:
+            conn.close()
+        current = dict(rows)
+        return {table: current.get(table, 0) for table in tables}
+
+    def bump(self, tables):
+        """Invalidate tables for every process; returns {table: new generation}"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO generations (name, generation) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET generation = generation + 1",
+                [(table,) for table in tables]
+            )
+            rows = conn.execute(
+                f"SELECT name, generation FROM generations WHERE name IN ({', '.join('?' for _ in tables)})",
+                list(tables)
+            ).fetchall()
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return dict(rows)
+
+    def publish(self, table, df, version, generation):
+        """Share a snapshot loaded under `generation`; dropped if the table was invalidated since"""
+        if table in self.private:
+            return False
+        payload = encode_frames({table: (df, version)})
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT generation FROM generations WHERE name = ?", (table,)).fetchone()
+            if (row[0] if row else 0) != generation:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO snapshots (name, generation, loaded_at, version, payload) VALUES (?, ?, ?, ?, ?)",
+                (table, generation, time.time(), json.dumps(version, default=str), payload)
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return True
+
+    def read(self, table, generation, max_age=None, version=None, since=None):
+        """(DataFrame, age seconds, version) published at `generation`, or None.
+
+        Optionally only if younger than max_age, loaded for `version`, or published after `since`.
+        """
+        if table in self.private:
+            return None
+        query = "SELECT loaded_at, payload FROM snapshots WHERE name = ? AND generation = ?"
+        params = [table, generation]
+        if max_age is not None:
+            query += " AND loaded_at >= ?"
+            params.append(time.time() - max_age)
+        if version is not None:
+            query += " AND version = ?"
+            params.append(json.dumps(version, default=str))
+        if since is not None:
+            query += " AND loaded_at >= ?"
+            params.append(since)
+        conn = self._connect()
+        try:
+            row = conn.execute(query, params).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        _, frames = decode_frames(row[1])
+        df, table_version = frames[table]
+        return df, max(0.0, time.time() - row[0]), table_version
+
+    def try_lease(self, table):
+        """Take the download lease of `table` unless another process holds a live one"""
+        if table in self.private:
+            return True  # nothing to wait for: no copy will be published
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (table,)).fetchone()
+            if row is not None and row[0] != self._holder and row[1] > now:
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)",
+                (table, self._holder, now + self.lease_seconds)
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return True
+
+    def release(self, table):
+        if table in self.private:
+            return
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (table, self._holder))
+        finally:
+            conn.close()
+
+
+@st.cache_resource
+def get_table_cache():
+    """Process-wide TableCache over the configured storage backend.
+
+    With the Sheets backend, the last good dataset on disk is served at once
+    and refreshed in the background, and server processes on the same host
+    share downloads and invalidations through SHARED_CACHE_PATH.
+    """
+    storage = get_storage()
+    sheets = storage.name == "sheets"
+    # Passwords never go to disk: credentials are always read from Sheets
+    persisted = {table: columns for table, columns in TABLE_LAYOUTS.items() if table != CREDENCIAL_TABLE}
+    snapshots = SnapshotStore(SNAPSHOT_PATH, persisted) if SNAPSHOT_PATH and sheets else None
+    cache = TableCache(
+        loader=lambda tables, previous: storage.load_tables(tables, previous=previous),
+        ttls={
+            CREDENCIAL_TABLE: CACHE_TTL_CREDENCIAL,
+            RESERVAS_TABLE: CACHE_TTL_RESERVAS,
+            GESTION_TABLE: CACHE_TTL_GESTION,
+        },
+        version_probe=storage.version_token if CHANGE_PROBE else None,
+        post_load=normalize_snapshot,
+        persist=snapshots.update if snapshots is not None else None,
+        shared=SharedTableStore(SHARED_CACHE_PATH, private=[CREDENCIAL_TABLE]) if SHARED_CACHE_PATH and sheets else None,
+        unversioned=storage.external_tables
+    )
+    if snapshots is not None:
+        warm = cache.warm_start(snapshots.load())
+        if warm:
+            threading.Thread(target=cache.revalidate, args=warm, name="warm-refresh", daemon=True).start()
+    if BACKGROUND_REFRESH:
+        cache.start_refresher(RESERVAS_TABLE, CACHE_TTL_RESERVAS * 0.8)
+    return cache
+
+def load_table(table, show_error=True):
+    """One cached table, or None if it could not be loaded"""
+    try:
+        return get_table_cache().get(table)
     except Exception as e:
-        st.error(f"Error descargando datos: {str(e)}")
-        return None, None, None
+        log_booking_attempt("TABLE_LOAD_FAILED", table, error=str(e))
+        if show_error:
+            st.error(f"Error descargando datos: {str(e)}")
+        return None
+
+def snapshot_age(table):
+    """Age in seconds of the cached snapshot of `table` (None if not loaded yet)"""
+    return get_table_cache().age(table)
+
+def storage_read_only():
+    """True while the Sheets backend is down: show the last snapshot, accept no changes"""
+    return STORAGE_BACKEND == "sheets" and SHEETS_BREAKER.is_open()
+
+def invalidate_tables(*tables):
+    """Targeted invalidation - only the tables that changed are refetched"""
+    get_table_cache().invalidate(*tables)
 
 
 def log_booking_attempt(action, details, success=None, error=None):
@@ -161,40 +2339,26 @@ def log_booking_attempt(action, details, success=None, error=None):
 
 def verify_booking_saved(spreadsheet, booking_data, max_retries=3):
     """Verify that booking was actually saved to Google Sheets"""
-    try:
-        for attempt in range(max_retries):
-            log_booking_attempt("VERIFY_ATTEMPT", f"Attempt {attempt + 1}/{max_retries}")
-            
-            # Get fresh data from sheets
-            reservas_ws = spreadsheet.worksheet("proveedor_reservas")
-            all_data = reservas_ws.get_all_values()
-            
-            if len(all_data) <= 1:  # Only headers
-                log_booking_attempt("VERIFY_FAILED", "No data found in sheet")
-                continue
-            
-            # Check last few rows for our booking
-            rows_to_check = min(5, len(all_data) - 1)  # Check last 5 rows
-            for i in range(len(all_data) - rows_to_check, len(all_data)):
-                row = all_data[i]
-                if len(row) >= 5:  # Ensure row has enough columns
-                    # Check if this row matches our booking
-                    if (row[0] == booking_data['Fecha'] and 
-                        row[1] == booking_data['Hora'] and 
-                        row[2] == booking_data['Proveedor'] and 
-                        row[3] == str(booking_data['Numero_de_bultos']) and 
-                        row[4] == booking_data['Orden_de_compra']):
-                        
-                        log_booking_attempt("VERIFY_SUCCESS", f"Booking found in row {i + 1}")
-                        return True, f"Booking verified in row {i + 1}"
-            
-            # If not found, wait and retry
-            if attempt < max_retries - 1:
-                log_booking_attempt("VERIFY_RETRY", f"Booking not found, waiting {attempt + 1} seconds")
-                time.sleep(attempt + 1)  # Progressive delay
+    expected = booking_row(booking_data)[:5]
+    
+    def find_booking():
+        # Get fresh data from sheets
+        reservas_ws = spreadsheet.worksheet("proveedor_reservas")
+        all_data = reservas_ws.get_all_values()
         
-        return False, "Booking not found after verification attempts"
+        # Check last few rows for our booking
+        for i in range(max(1, len(all_data) - 5), len(all_data)):
+            if all_data[i][:5] == expected:
+                log_booking_attempt("VERIFY_SUCCESS", f"Booking found in row {i + 1}")
+                return True, f"Booking verified in row {i + 1}"
         
+        # Not visible yet - the retry policy decides whether to wait
+        raise TransientError("Booking not found in the last rows")
+    
+    try:
+        return SHEETS_RETRY.run("verify", find_booking, max_attempts=max_retries)
+    except TransientError:
+        return False, "Booking not found after verification attempts"
     except Exception as e:
         error_msg = f"Verification failed: {str(e)}"
         log_booking_attempt("VERIFY_ERROR", "", error=error_msg)
@@ -203,7 +2367,7 @@ def verify_booking_saved(spreadsheet, booking_data, max_retries=3):
 def get_sheet_row_count(worksheet):
     """Get the current number of rows in the worksheet"""
     try:
-        all_values = worksheet.get_all_values()
+        all_values = SHEETS_RETRY.run("get_all_values", worksheet.get_all_values)
         # Subtract 1 for header row to get actual data rows
         data_rows = len(all_values) - 1 if all_values else 0
         return max(0, data_rows)
@@ -214,7 +2378,7 @@ def get_sheet_row_count(worksheet):
 
 def save_booking_to_sheets_enhanced(new_booking):
     """
-    Enhanced save function with row count and specific booking verification
+    Save a booking through the configured storage backend
     
     Error Codes for User Messages:
     - Error código 1: Database connection failures (can't connect to Google Sheets, can't load data)
@@ -225,155 +2389,43 @@ def save_booking_to_sheets_enhanced(new_booking):
     booking_id = f"{new_booking['Proveedor']}_{new_booking['Fecha']}_{new_booking['Hora']}"
     
     try:
-        log_booking_attempt("SAVE_START", f"Booking ID: {booking_id}")
-        
-        # Step 1: Clear cache and get fresh data
-        log_booking_attempt("CACHE_CLEAR", "Clearing cached data")
-        download_sheets_to_memory.clear()
-        credentials_df, reservas_df, gestion_df = download_sheets_to_memory()
-        
-        if reservas_df is None:
-            error_msg = "Failed to load data from Google Sheets"
-            log_booking_attempt("DATA_LOAD_FAILED", booking_id, success=False, error=error_msg)
-            st.error("❌ Debido a errores de servidor, no se pudo concretar la reserva. Por favor intentar luego después de unos minutos (Error código 1)")
-            return False, error_msg
-
-        log_booking_attempt("DATA_LOADED", f"Loaded {len(reservas_df)} existing reservations")
-
-        # Step 2: Final availability check
-        fecha_reserva = new_booking['Fecha']
-        hora_reserva = new_booking['Hora']
-        
-        log_booking_attempt("AVAILABILITY_CHECK", f"Date: {fecha_reserva}, Time: {hora_reserva}")
-        
-        existing_booking = reservas_df[
-            (reservas_df['Fecha'].astype(str).str.contains(fecha_reserva.split(' ')[0], na=False)) & 
-            (reservas_df['Hora'].astype(str) == hora_reserva)
-        ]
-        
-        if not existing_booking.empty:
-            error_msg = "Slot already booked by another provider"
-            log_booking_attempt("SLOT_TAKEN", booking_id, success=False, error=error_msg)
-            st.error("❌ Otro proveedor acaba de reservar este horario")
-            download_sheets_to_memory.clear()
-            return False, error_msg
-
-        log_booking_attempt("SLOT_AVAILABLE", f"Slot confirmed available for {booking_id}")
-
-        # Step 3: Get Google Sheets connection
-        log_booking_attempt("SHEETS_CONNECT", "Establishing Google Sheets connection")
-        gc = setup_google_sheets()
-        if not gc:
-            error_msg = "Failed to connect to Google Sheets"
-            log_booking_attempt("SHEETS_CONNECTION_FAILED", booking_id, success=False, error=error_msg)
-            st.error("❌ Debido a errores de servidor, no se pudo concretar la reserva. Por favor intentar luego después de unos minutos (Error código 1)")
-            return False, error_msg
-
-        spreadsheet = gc.open(st.secrets["GOOGLE_SHEET_NAME"])
-        reservas_ws = spreadsheet.worksheet("proveedor_reservas")
+        storage = get_storage()
+        log_booking_attempt("SAVE_START", f"Booking ID: {booking_id} (backend: {storage.name})")
         
-        log_booking_attempt("WORKSHEET_ACCESSED", "proveedor_reservas worksheet accessed")
-
-        # Step 4: Get initial row count BEFORE saving
-        initial_row_count = get_sheet_row_count(reservas_ws)
-        if initial_row_count == -1:
-            error_msg = "Failed to get initial row count"
-            log_booking_attempt("INITIAL_COUNT_FAILED", booking_id, success=False, error=error_msg)
-            st.error("❌ Debido a errores de servidor, no se pudo concretar la reserva. Por favor intentar luego después de unos minutos (Error código 2)")
-            return False, error_msg
+        # SQLite checks and inserts in one transaction; other backends go through
+        # the compare-and-set ledger so concurrent confirmations cannot both write
+        if storage.atomic_commit:
+            save_message = storage.append_reserva(new_booking)
+        else:
+            save_message = commit_booking(storage, new_booking)
         
-        log_booking_attempt("INITIAL_ROW_COUNT", f"Rows before save: {initial_row_count}")
-
-        # Step 5: Prepare data for saving
-        new_row_data = [
-            new_booking['Fecha'],
-            new_booking['Hora'],
-            new_booking['Proveedor'],
-            str(new_booking['Numero_de_bultos']),
-            new_booking['Orden_de_compra']
-        ]
+        # Only reservas changed
+        invalidate_tables(RESERVAS_TABLE)
+        log_booking_attempt("SAVE_COMPLETE", f"{booking_id} {save_message}", success=True)
+        return True, save_message
     
-        log_booking_attempt("DATA_PREPARED", f"Row data: {new_row_data}")
-
-        # Attempt to save with retry logic
-        max_save_attempts = 10
-        save_success = False
-        last_error = None
+    except SlotTakenError as e:
+        error_msg = str(e)
+        log_booking_attempt("SLOT_TAKEN", booking_id, success=False, error=error_msg)
+        st.error("❌ Otro proveedor acaba de reservar este horario")
+        invalidate_tables(RESERVAS_TABLE)
+        return False, error_msg
+    
+    except StorageError as e:
+        error_msg = str(e)
+        log_booking_attempt("SAVE_FAILED_FINAL", booking_id, success=False, error=error_msg)
+        # The row may have been written: never keep serving the pre-write snapshot
+        invalidate_tables(RESERVAS_TABLE)
         
-        for attempt in range(max_save_attempts):
-            try:
-                log_booking_attempt("SAVE_ATTEMPT", f"Attempt {attempt + 1}/{max_save_attempts} for {booking_id}")
-                
-                # Save to sheets
-                #reservas_ws.append_row(new_row_data, value_input_option='RAW')
-                #log_booking_attempt("APPEND_REQUESTED", f"append_row() request sent for {booking_id}")
-                
-                #new append starts
-                all_values = reservas_ws.get_all_values()
-                next_row = len(all_values) + 1
-                col_range = f'A{next_row}:E{next_row}'
-                reservas_ws.update(
-                    range_name=col_range,
-                    values=[new_row_data],
-                    value_input_option='RAW'
-                )                
-                log_booking_attempt("APPEND_REQUESTED", f"Updated row {next_row} for {booking_id}")
-                #new append ends
-
-                # Wait a moment for Google Sheets to process
-                time.sleep(5)
-                
-                # Step 5: Verify the specific booking was saved (CONTENT-ONLY VALIDATION)
-                log_booking_attempt("PROCESSING_WAIT", f"Waiting for Google Sheets to process {booking_id}")
-                
-                verification_success, verification_message = verify_booking_saved(spreadsheet, new_booking)
-                
-                if verification_success:
-                    log_booking_attempt("BOOKING_SAVE_SUCCESS", f"{booking_id} successfully saved and verified", success=True)
-                    save_success = True
-                    break
-                else:
-                    last_error = f"BOOKING_VERIFICATION_FAILED: {verification_message}"
-                    log_booking_attempt("BOOKING_VERIFICATION_FAILED", f"{booking_id} save failed - content not found: {verification_message}", success=False)
-                    
-                    if attempt < max_save_attempts - 1:
-                        wait_time = (attempt + 1) * 2
-                        log_booking_attempt("SAVE_RETRY_WAIT", f"Waiting {wait_time} seconds before retry")
-                        time.sleep(wait_time)
-                
-            except Exception as save_error:
-                last_error = f"API_FAILURE: Save attempt {attempt + 1} failed: {str(save_error)}"
-                log_booking_attempt("SAVE_ATTEMPT_ERROR", f"{booking_id}", error=last_error)
-                
-                if attempt < max_save_attempts - 1:
-                    wait_time = (attempt + 1) * 2
-                    time.sleep(wait_time)
+        # Show user-friendly error message with appropriate error code
+        st.error(f"❌ Debido a errores de servidor, no se pudo concretar la reserva. Por favor intentar luego después de unos minutos (Error código {e.code})")
         
-        if save_success:
-            # Clear cache after successful save
-            download_sheets_to_memory.clear()
-            log_booking_attempt("SAVE_COMPLETE", f"{booking_id} successfully saved and verified", success=True)
-            return True, "Booking saved and verified successfully"
-        else:
-            # Determine error code based on the type of failure
-            if "BOOKING_VERIFICATION_FAILED" in last_error:
-                error_code = "4"  # Booking verification failure
-            elif "API_FAILURE" in last_error:
-                error_code = "2"  # API failure
-            else:
-                error_code = "2"  # Default to API failure
-            
-            error_msg = f"Failed to save after {max_save_attempts} attempts. Last error: {last_error}"
-            log_booking_attempt("SAVE_FAILED_FINAL", booking_id, success=False, error=error_msg)
-            
-            # Show user-friendly error message with appropriate error code
-            st.error(f"❌ Debido a errores de servidor, no se pudo concretar la reserva. Por favor intentar luego después de unos minutos (Error código {error_code})")
-            
-            return False, error_msg
+        return False, error_msg
         
     except Exception as e:
         error_msg = f"Unexpected error in save_booking_to_sheets_enhanced: {str(e)}"
         log_booking_attempt("SAVE_EXCEPTION", booking_id, success=False, error=error_msg)
+        invalidate_tables(RESERVAS_TABLE)
         
         # Show user-friendly error message
         st.error("❌ Debido a errores de servidor, no se pudo concretar la reserva. Por favor intentar luego después de unos minutos (Error código 2)")
@@ -382,34 +2434,35 @@ def save_booking_to_sheets_enhanced(new_booking):
 
 def get_duration_and_slots_info(numero_bultos, selected_slot):
     """Get duration text and combined slots based on bultos"""
-    if numero_bultos >= 8:
-        # 60 minutes (3 x 20-minute slots)
-        slot1 = selected_slot
-        slot2 = get_next_slot(slot1)
-        slot3 = get_next_slot(slot2)
-        combined_hora = f"{slot1}:00, {slot2}:00, {slot3}:00"
-        duration_text = " (60 minutos)"
-        duration_minutes = 60
-    elif numero_bultos >= 4:
-        # 40 minutes (2 x 20-minute slots)
-        slot1 = selected_slot
-        slot2 = get_next_slot(slot1)
-        combined_hora = f"{slot1}:00, {slot2}:00"
-        duration_text = " (40 minutos)"
-        duration_minutes = 40
-    else:
-        # 20 minutes (single slot)
-        combined_hora = f"{selected_slot}:00"
-        duration_text = " (20 minutos)"
-        duration_minutes = 20
+    slots_needed = slots_needed_for(numero_bultos)
+    start = slot_index(selected_slot)
+    combined_hora = ", ".join(f"{slot_label(start + k)}:00" for k in range(slots_needed))
+    duration_minutes = slots_needed * SLOT_MINUTES
+    duration_text = f" ({duration_minutes} minutos)"
     
     return combined_hora, duration_text, duration_minutes
 
+@sheets_priority(SHEETS_PRIORITY_HIGH)
 def enhanced_confirmation_process(selected_date, selected_slot, numero_bultos, valid_orders, supplier_name, supplier_email, supplier_cc_emails):
     """Enhanced confirmation process with proper error handling and logging"""
     
     log_booking_attempt("CONFIRMATION_START", f"User: {supplier_name}, Date: {selected_date}, Slot: {selected_slot}")
     
+    # Refuse orders that already have a booking before any write
+    try:
+        reservas_df = get_table_cache().get(RESERVAS_TABLE, max_age=FINAL_CHECK_MAX_AGE)
+    except Exception as e:
+        # Without the snapshot the duplicate check cannot run: refuse rather than skip it
+        log_booking_attempt("DUPLICATE_CHECK_SNAPSHOT_FAILED", supplier_name, success=False, error=str(e))
+        st.error("❌ No se pudieron verificar las órdenes de compra. Intente nuevamente en unos momentos.")
+        return False
+    booked_orders = find_booked_orders(reservas_df, valid_orders)
+    if booked_orders:
+        log_booking_attempt("DUPLICATE_ORDER", f"{supplier_name}: {', '.join(booked_orders)}", success=False)
+        for orden, (fecha, hora) in booked_orders.items():
+            st.error(f"❌ La orden {orden} ya tiene una entrega reservada el {fecha} a las {hora}")
+        return False
+    
     # Final availability check
     with st.spinner("Verificando disponibilidad final..."):
         is_still_available, availability_message = check_slot_availability(selected_date, selected_slot, numero_bultos)
@@ -457,24 +2510,42 @@ def enhanced_confirmation_process(selected_date, selected_slot, numero_bultos, v
     # Only send email if save was successful and verified
     log_booking_attempt("BOOKING_SAVED", f"{supplier_name} - {save_message}", success=True)
     st.success("✅ Reserva confirmada y verificada!")
+    if DOCK_COUNT > 1 and booking_to_save.get('Anden'):
+        st.info(f"🚪 Andén asignado: {booking_to_save['Anden']}")
     
-    # Send email
+    # Queue email - delivered by the outbox worker so the page returns immediately
     if supplier_email:
-        log_booking_attempt("EMAIL_START", f"Sending to {supplier_email}")
+        booking_id = f"{supplier_name}_{booking_to_save['Fecha']}_{booking_to_save['Hora']}"
+        log_booking_attempt("EMAIL_START", f"Queueing for {supplier_email}")
         
-        with st.spinner("Enviando confirmación por email..."):
-            email_sent, actual_cc_emails = send_booking_email(
-                supplier_email,
-                supplier_name,
-                booking_to_save,
-                supplier_cc_emails
-            )
+        email_queued, actual_cc_emails = queue_booking_email(
+            booking_id,
+            supplier_email,
+            supplier_name,
+            booking_to_save,
+            supplier_cc_emails
+        )
+        
+        email_sent = False
+        if not email_queued:
+            # Outbox unavailable - fall back to sending inline
+            with st.spinner("Enviando confirmación por email..."):
+                email_sent, actual_cc_emails = send_booking_email(
+                    supplier_email,
+                    supplier_name,
+                    booking_to_save,
+                    supplier_cc_emails
+                )
         
         if email_sent:
-            log_booking_attempt("EMAIL_SUCCESS", f"Email sent to {supplier_email}, CC: {actual_cc_emails}", success=True)
             st.success(f"📧 Email de confirmación enviado a: {supplier_email}")
             if actual_cc_emails:
                 st.success(f"📧 CC enviado a: {', '.join(actual_cc_emails)}")
+        elif email_queued:
+            # Delivered by the outbox worker a moment later (retried if the mail API is down)
+            st.success(f"📧 Email de confirmación en cola para: {supplier_email}")
+            if actual_cc_emails:
+                st.success(f"📧 CC en cola para: {', '.join(actual_cc_emails)}")
         else:
             log_booking_attempt("EMAIL_FAILED", f"Failed to send email to {supplier_email}", success=False)
             st.warning("⚠️ Reserva guardada exitosamente pero error enviando email")
@@ -505,111 +2576,361 @@ def enhanced_confirmation_process(selected_date, selected_slot, numero_bultos, v
 #     resp.raise_for_status()
 #     return resp
 
-MAIL_REPLY_TO = MAIL_FROM_EMAIL
+MAIL_REPLY_TO = MAIL_FROM_EMAIL
+
+
+class MailTransport:
+    """Keep-alive HTTP session to the Magento mail endpoint with a bounded send pool.
+
+    Used by every notification type; exposes per-send latency and error counters.
+    """
+
+    def __init__(self, api_url, api_token, pool_size=4, timeout=30):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_token}",
+            "Content-Type": "application/json",
+        })
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="mail-send")
+        self._stats_lock = threading.Lock()
+        self._stats = {"sent": 0, "errors": 0, "total_latency": 0.0, "max_latency": 0.0, "last_latency": 0.0}
+
+    def _record(self, latency, ok):
+        with self._stats_lock:
+            self._stats["sent" if ok else "errors"] += 1
+            self._stats["total_latency"] += latency
+            self._stats["max_latency"] = max(self._stats["max_latency"], latency)
+            self._stats["last_latency"] = latency
+
+    def stats(self):
+        """Counters snapshot, plus average latency in seconds"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        calls = stats["sent"] + stats["errors"]
+        stats["avg_latency"] = stats["total_latency"] / calls if calls else 0.0
+        return stats
+
+    def send(self, to_field, subject, html_body, cc="", bcc="", reply_to=MAIL_REPLY_TO):
+        """Send one message. Raises on non-2xx."""
+        payload = {
+            "from": {"email": MAIL_FROM_EMAIL, "name": MAIL_FROM_NAME},
+            "to": to_field,
+            "cc": cc,
+            "bcc": bcc,
+            "reply_to": reply_to,
+            "subject": subject,
+            "body": html_body,
+        }
+        started = time.monotonic()
+        try:
+            resp = self.session.post(self.api_url, json=payload, timeout=request_timeout(self.timeout))
+            resp.raise_for_status()
+        except Exception:
+            self._record(time.monotonic() - started, ok=False)
+            raise
+        self._record(time.monotonic() - started, ok=True)
+        return resp
+
+    def send_many(self, messages):
+        """Send (to_field, subject, html_body) tuples concurrently, once each.
+
+        Returns [(ok, exception or None)] in order.
+        """
+        futures = [self._executor.submit(self.send, *message) for message in messages]
+        results = []
+        for future in futures:
+            try:
+                future.result()
+                results.append((True, None))
+            except Exception as e:
+                results.append((False, e))
+        return results
+
+
+@st.cache_resource
+def _default_mail_transport():
+    return MailTransport(MAIL_API_URL, MAIL_API_TOKEN, pool_size=MAIL_POOL_SIZE, timeout=MAIL_RETRY_DEADLINE)
+
+_mail_transport_override = None
+
+def set_mail_transport(transport):
+    """Send all mail through `transport` instead of the MAIL_API_URL session (None restores it).
+
+    This is the injection point for exercising the mail path without the
+    Magento endpoint: anything with MailTransport's send()/send_many()
+    works, typically MailTransport("http://127.0.0.1:8025/send", "test")
+    in front of a local HTTP stub. Inline sends switch at once and the
+    outbox worker on its next batch.
+    """
+    global _mail_transport_override
+    _mail_transport_override = transport
+
+def get_mail_transport():
+    """Process-wide MailTransport (or the one set with set_mail_transport)"""
+    return _mail_transport_override or _default_mail_transport()
+
+def _post_mail(to_field, subject, html_body, cc="", bcc="", reply_to=MAIL_REPLY_TO):
+    """Send one request to the Dismac Magento mail endpoint. Raises on non-2xx (after MAIL_RETRY)."""
+    transport = get_mail_transport()
+    # Not idempotent: a 5xx or read timeout may follow an accepted message, so only rejected sends are retried
+    return MAIL_RETRY.run("send", lambda: transport.send(to_field, subject, html_body, cc=cc, bcc=bcc, reply_to=reply_to),
+                          idempotent=False)
+
+
+
+def build_booking_email(supplier_email, supplier_name, booking_details, cc_emails=None):
+    """Build (recipients, subject, html_body) for a booking confirmation."""
+    # --- Build full recipient list (supplier + CCs + defaults), deduped ---
+    defaults = ["ljbyon@dismac.com.bo", "marketplace@dismac.com.bo"]
+    recipients = [supplier_email] + (list(cc_emails) if cc_emails else []) + defaults
+
+    seen = set()
+    recipients = [e for e in recipients
+                  if e and not (e in seen or seen.add(e))]
+
+    subject = "Confirmación de Reserva para Entrega de Mercadería"
+
+    # --- Time / duration display ---
+    display_fecha = booking_details['Fecha'].split(' ')[0]
+    start, num_slots = parse_hora(booking_details['Hora'])
+    if num_slots > 1:
+        end_minutes = DAY_START_MINUTES + (start + num_slots) * SLOT_MINUTES
+        end_time = f"{end_minutes // 60:02d}:{end_minutes % 60:02d}"
+        display_hora = f"{slot_label(start)} - {end_time}"
+        duration_minutes = num_slots * SLOT_MINUTES
+        duration_info = f" (Duración: {duration_minutes} minutos)"
+    else:
+        display_hora = slot_label(start)
+        duration_info = f" (Duración: {SLOT_MINUTES} minutos)"
+
+    # --- Dock (only meaningful with more than one) ---
+    dock_line = f'🚪 Andén: {booking_details["Anden"]}<br>' if DOCK_COUNT > 1 and booking_details.get('Anden') else ''
+
+    # --- PDF link ---
+    pdf_link = f"https://drive.google.com/file/d/{st.secrets['PDF_FILE_ID']}/view"
+
+    # --- HTML body with explicit <br> line breaks ---
+    sep = "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
+    html_body = (
+        '<html><body style="font-family:Arial,sans-serif;font-size:14px;color:#222;">'
+        f'Hola {supplier_name},<br><br>'
+        'Su reserva de entrega ha sido confirmada exitosamente.<br><br>'
+        'DETALLES DE LA RESERVA:<br>'
+        f'{sep}<br>'
+        f'📅 Fecha: {display_fecha}<br>'
+        f'🕐 Horario: {display_hora}{duration_info}<br>'
+        f'{dock_line}'
+        f'📦 Número de bultos: {booking_details["Numero_de_bultos"]}<br>'
+        f'📋 Orden de compra: {booking_details["Orden_de_compra"]}<br><br>'
+        'INSTRUCCIONES:<br>'
+        f'{sep}<br>'
+        '• Respeta el horario reservado para tu entrega.<br>'
+        '• En caso de retraso, podrías tener que esperar hasta el próximo cupo disponible del día o reprogramar tu entrega.<br>'
+        '• Dismac no se responsabiliza por los tiempos de espera ocasionados por llegadas fuera de horario.<br>'
+        '• Además, según el tipo de venta, es importante considerar lo siguiente:<br>'
+        '&nbsp;&nbsp;- Venta al contado: Debes entregar el pedido junto con la factura a nombre del comprador y tres (3) copias de la orden de compra.<br>'
+        '&nbsp;&nbsp;- Venta en minicuotas: Debes entregar el pedido junto con la factura a nombre de Dismatec S.A. y una (1) copia de la orden de compra.<br>'
+        '• Entregar impreso en almacén este correo.<br><br>'
+        'REQUISITOS DE SEGURIDAD<br>'
+        '• Pantalón largo, sin rasgados<br>'
+        '• Botines de seguridad<br>'
+        '• Casco de seguridad<br>'
+        '• Chaleco o camisa con reflectivo<br>'
+        '• No está permitido manillas, cadenas, y principalmente masticar coca.<br><br>'
+        f'📄 <a href="{pdf_link}">Guía del Seller Dismac Marketplace</a><br><br>'
+        'Gracias por utilizar nuestro sistema de reservas.<br><br>'
+        'Saludos cordiales,<br>'
+        'Equipo de Almacén Dismac'
+        '</body></html>'
+    )
+
+    return recipients, subject, html_body
+
+
+def send_booking_email(supplier_email, supplier_name, booking_details, cc_emails=None):
+    """Send booking confirmation via Magento mail API (single comma-separated 'to')."""
+    try:
+        recipients, subject, html_body = build_booking_email(
+            supplier_email, supplier_name, booking_details, cc_emails
+        )
+        to_field = ",".join(recipients)  # no spaces — safest for the Magento handler
+
+        # --- Single send to everyone ---
+        _post_mail(to_field, subject, html_body)
+
+        # supplier is first; the rest are reported as CC by the caller
+        return True, recipients[1:]
+
+    except Exception as e:
+        st.error(f"Error enviando email: {str(e)}")
+        return False, []
+
 
+class EmailOutbox:
+    """Durable mail queue (SQLite) drained by a background worker thread.
 
-def _post_mail(to_field, subject, html_body, cc="", bcc="", reply_to=MAIL_REPLY_TO):
-    """Send one request to the Dismac Magento mail endpoint. Raises on non-2xx."""
-    payload = {
-        "from": {"email": MAIL_FROM_EMAIL, "name": MAIL_FROM_NAME},
-        "to": to_field,
-        "cc": cc,
-        "bcc": bcc,
-        "reply_to": reply_to,
-        "subject": subject,
-        "body": html_body,
-    }
-    headers = {
-        "Authorization": f"Bearer {MAIL_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    resp = requests.post(MAIL_API_URL, json=payload, headers=headers, timeout=30)
-    resp.raise_for_status()
-    return resp
+    Messages survive restarts; failed sends are retried with exponential
+    backoff and the delivery status is kept per booking.
+    """
 
+    MAX_ATTEMPTS = 8
+    BASE_DELAY = 5          # seconds before the first retry
+    MAX_DELAY = 30 * 60     # cap between retries
+    SENDING_TIMEOUT = 5 * 60  # 'sending' rows older than this were orphaned by a crash
 
+    def __init__(self, path, transport=None, poll_interval=10):
+        self.path = path
+        self.transport = transport  # None: get_mail_transport(), looked up per batch
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._worker = None
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    booking_id TEXT NOT NULL,
+                    to_field TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    html_body TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_booking ON outbox (booking_id)")
+        finally:
+            conn.close()
 
-def send_booking_email(supplier_email, supplier_name, booking_details, cc_emails=None):
-    """Send booking confirmation via Magento mail API (single comma-separated 'to')."""
-    try:
-        # --- Build full recipient list (supplier + CCs + defaults), deduped ---
-        defaults = ["ljbyon@dismac.com.bo", "marketplace@dismac.com.bo"]
-        recipients = [supplier_email] + (list(cc_emails) if cc_emails else []) + defaults
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
 
-        seen = set()
-        recipients = [e for e in recipients
-                      if e and not (e in seen or seen.add(e))]
+    def enqueue(self, booking_id, to_field, subject, html_body):
+        """Persist a message and wake the worker. Returns the outbox id"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO outbox (booking_id, to_field, subject, html_body, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (booking_id, to_field, subject, html_body, now, now, now)
+            )
+            message_id = cursor.lastrowid
+        finally:
+            conn.close()
+        log_booking_attempt("EMAIL_QUEUED", f"{booking_id} -> {to_field} (outbox id {message_id})")
+        self._wake.set()
+        return message_id
 
-        to_field = ",".join(recipients)  # no spaces — safest for the Magento handler
+    def _claim_due(self, limit=10):
+        """Move due messages to 'sending' so no other worker picks them up"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE outbox SET status = 'pending', updated_at = ? WHERE status = 'sending' AND updated_at < ?",
+                (now, now - self.SENDING_TIMEOUT)
+            )
+            rows = conn.execute(
+                "SELECT id, booking_id, to_field, subject, html_body, attempts FROM outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET status = 'sending', updated_at = ? WHERE id = ?",
+                [(now, row[0]) for row in rows]
+            )
+            conn.execute("COMMIT")
+            return rows
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
 
-        subject = "Confirmación de Reserva para Entrega de Mercadería"
-
-        # --- Time / duration display ---
-        display_fecha = booking_details['Fecha'].split(' ')[0]
-        hora_field = booking_details['Hora']
-        if ',' in hora_field:
-            slots = [slot.strip() for slot in hora_field.split(',')]
-            start_time = slots[0].rsplit(':', 1)[0]
-            last_slot = slots[-1].split(':')
-            end_hour = int(last_slot[0])
-            end_minute = int(last_slot[1]) + 20
-            if end_minute >= 60:
-                end_hour += end_minute // 60
-                end_minute = end_minute % 60
-            end_time = f"{end_hour:02d}:{end_minute:02d}"
-            display_hora = f"{start_time} - {end_time}"
-            num_slots = len(slots)
-            duration_minutes = num_slots * 20
-            duration_info = f" (Duración: {duration_minutes} minutos)"
-        else:
-            display_hora = hora_field.rsplit(':', 1)[0]
-            duration_info = " (Duración: 20 minutos)"
-
-        # --- PDF link ---
-        pdf_link = f"https://drive.google.com/file/d/{st.secrets['PDF_FILE_ID']}/view"
-
-        # --- HTML body with explicit <br> line breaks ---
-        sep = "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━"
-        html_body = (
-            '<html><body style="font-family:Arial,sans-serif;font-size:14px;color:#222;">'
-            f'Hola {supplier_name},<br><br>'
-            'Su reserva de entrega ha sido confirmada exitosamente.<br><br>'
-            'DETALLES DE LA RESERVA:<br>'
-            f'{sep}<br>'
-            f'📅 Fecha: {display_fecha}<br>'
-            f'🕐 Horario: {display_hora}{duration_info}<br>'
-            f'📦 Número de bultos: {booking_details["Numero_de_bultos"]}<br>'
-            f'📋 Orden de compra: {booking_details["Orden_de_compra"]}<br><br>'
-            'INSTRUCCIONES:<br>'
-            f'{sep}<br>'
-            '• Respeta el horario reservado para tu entrega.<br>'
-            '• En caso de retraso, podrías tener que esperar hasta el próximo cupo disponible del día o reprogramar tu entrega.<br>'
-            '• Dismac no se responsabiliza por los tiempos de espera ocasionados por llegadas fuera de horario.<br>'
-            '• Además, según el tipo de venta, es importante considerar lo siguiente:<br>'
-            '&nbsp;&nbsp;- Venta al contado: Debes entregar el pedido junto con la factura a nombre del comprador y tres (3) copias de la orden de compra.<br>'
-            '&nbsp;&nbsp;- Venta en minicuotas: Debes entregar el pedido junto con la factura a nombre de Dismatec S.A. y una (1) copia de la orden de compra.<br>'
-            '• Entregar impreso en almacén este correo.<br><br>'
-            'REQUISITOS DE SEGURIDAD<br>'
-            '• Pantalón largo, sin rasgados<br>'
-            '• Botines de seguridad<br>'
-            '• Casco de seguridad<br>'
-            '• Chaleco o camisa con reflectivo<br>'
-            '• No está permitido manillas, cadenas, y principalmente masticar coca.<br><br>'
-            f'📄 <a href="{pdf_link}">Guía del Seller Dismac Marketplace</a><br><br>'
-            'Gracias por utilizar nuestro sistema de reservas.<br><br>'
-            'Saludos cordiales,<br>'
-            'Equipo de Almacén Dismac'
-            '</body></html>'
-        )
+    def _mark(self, message_id, status, attempts, next_attempt_at=None, error=None):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                (status, attempts, next_attempt_at or now, error, now, message_id)
+            )
+        finally:
+            conn.close()
 
-        # --- Single send to everyone ---
-        _post_mail(to_field, subject, html_body)
+    def _retry_delay(self, attempts):
+        return min(self.MAX_DELAY, self.BASE_DELAY * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
 
-        # supplier is first; the rest are reported as CC by the caller
-        return True, recipients[1:]
+    def drain_once(self):
+        """Send every due message once. Returns the number processed"""
+        rows = self._claim_due()
+        # The whole batch goes out concurrently on the transport's pool
+        results = (self.transport or get_mail_transport()).send_many([(row[2], row[3], row[4]) for row in rows])
+        for (message_id, booking_id, to_field, _, _, attempts), (ok, exception) in zip(rows, results):
+            attempts += 1
+            if ok:
+                self._mark(message_id, 'sent', attempts)
+                log_booking_attempt("EMAIL_SUCCESS", f"{booking_id} delivered to {to_field}", success=True)
+                continue
+            error = str(exception)
+            _, retryable, retry_after = classify_error(exception)
+            if not retryable or attempts >= self.MAX_ATTEMPTS:
+                self._mark(message_id, 'failed', attempts, error=error)
+                log_booking_attempt("EMAIL_FAILED", f"{booking_id} gave up after {attempts} attempts", success=False, error=error)
+            else:
+                # A Retry-After hint from the mail API is a lower bound
+                delay = max(self._retry_delay(attempts), retry_after or 0)
+                self._mark(message_id, 'pending', attempts, time.time() + delay, error)
+                log_booking_attempt("EMAIL_RETRY", f"{booking_id} attempt {attempts} failed, retrying in {delay:.0f}s", error=error)
+        return len(rows)
+
+    def _run(self):
+        while True:
+            try:
+                if self.drain_once():
+                    continue
+            except Exception as e:
+                log_booking_attempt("OUTBOX_WORKER_ERROR", self.path, error=str(e))
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def start(self):
+        """Start the background worker (idempotent)"""
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+            self._worker.start()
+        return self
+
+
+@st.cache_resource
+def get_email_outbox():
+    """Process-wide outbox with its worker running (also resumes mail queued before a restart)"""
+    return EmailOutbox(MAIL_OUTBOX_PATH).start()
 
+def queue_booking_email(booking_id, supplier_email, supplier_name, booking_details, cc_emails=None):
+    """Queue the booking confirmation for background delivery. Returns (queued, cc_recipients)"""
+    try:
+        recipients, subject, html_body = build_booking_email(
+            supplier_email, supplier_name, booking_details, cc_emails
+        )
+        get_email_outbox().enqueue(booking_id, ",".join(recipients), subject, html_body)
+        return True, recipients[1:]
     except Exception as e:
-        st.error(f"Error enviando email: {str(e)}")
+        log_booking_attempt("EMAIL_QUEUE_FAILED", booking_id, success=False, error=str(e))
         return False, []
 
 # ─────────────────────────────────────────────────────────────
@@ -664,155 +2985,669 @@ def format_time_slot(time_str):
     except (ValueError, AttributeError, TypeError):
         return None
 
-def generate_all_20min_slots():
-    """Generate all possible 20-minute slots"""
-    weekday_slots = []
-    saturday_slots = []
-    
-    # Weekday slots (9:00-16:00)
-    for hour in range(9, 16):
-        for minute in [0, 20, 40]:
-            start_time = f"{hour:d}:{minute:02d}"
-            weekday_slots.append(start_time)
-    
-    # Saturday slots (9:00-12:00)
-    for hour in range(9, 12):
-        for minute in [0, 20, 40]:
-            start_time = f"{hour:d}:{minute:02d}"
-            saturday_slots.append(start_time)
-    
-    return weekday_slots, saturday_slots
+WEEKDAY_KEYS = ("lun", "mar", "mie", "jue", "vie", "sab", "dom")
 
-def get_next_slot(slot_time):
-    """Get the next 20-minute slot"""
-    hour, minute = map(int, slot_time.split(':'))
-    
-    if minute == 0:
-        next_slot = f"{hour:d}:20"
-    elif minute == 20:
-        next_slot = f"{hour:d}:40"
-    else:  # minute == 40
-        next_hour = hour + 1
-        next_slot = f"{next_hour:d}:00"
-    
-    return next_slot
+# Used for any key missing from the [work_calendar] secrets table
+DEFAULT_WORK_CALENDAR = {
+    "slot_minutes": 20,
+    "weekly": {
+        "lun": "9:00-16:00", "mar": "9:00-16:00", "mie": "9:00-16:00",
+        "jue": "9:00-16:00", "vie": "9:00-16:00", "sab": "9:00-12:00",
+    },
+    "holidays": [],
+    # December 24, 2025 - only allow reservations until 3pm
+    "special_days": {"2025-12-24": "9:00-15:00"},
+}
 
-def find_contiguous_slots(all_slots, booked_slots, slots_needed):
-    """Find available contiguous slots based on number of slots needed"""
-    available_slots = []
-    
-    for i in range(len(all_slots) - (slots_needed - 1)):
-        # Check if we have enough consecutive slots
-        slots_to_check = []
-        current = all_slots[i]
-        slots_to_check.append(current)
-        
-        # Get the next slots needed
-        for j in range(1, slots_needed):
-            next_expected = get_next_slot(slots_to_check[-1])
-            if i + j < len(all_slots) and all_slots[i + j] == next_expected:
-                slots_to_check.append(all_slots[i + j])
-            else:
-                break
-        
-        # Check if we found all needed consecutive slots
-        if len(slots_to_check) == slots_needed:
-            # Check if all slots are available
-            if all(slot not in booked_slots for slot in slots_to_check):
-                available_slots.append(current)
-    
-    return available_slots
+def parse_hours_range(value):
+    """'9:00-16:00' -> (540, 960) minutes; empty/None -> None (closed)"""
+    if not value:
+        return None
+    opens, closes = (part.strip().split(':') for part in str(value).split('-'))
+    return int(opens[0]) * 60 + int(opens[1]), int(closes[0]) * 60 + int(closes[1])
 
-def get_available_slots(selected_date, reservas_df, numero_bultos):
-    """Get available slots for a date based on bultos count"""
-    weekday_slots, saturday_slots = generate_all_20min_slots()
-    
-    # Sunday = 6, no work
-    if selected_date.weekday() == 6:
-        return []
-    
-    # Saturday = 5
-    if selected_date.weekday() == 5:
-        all_20min_slots = saturday_slots
-    else:
-        all_20min_slots = weekday_slots
 
-    
-    
-    
-    # Special case: December 24, 2025 - only allow reservations until 3pm
-    if selected_date.year == 2025 and selected_date.month == 12 and selected_date.day == 24:
-        all_20min_slots = [slot for slot in all_20min_slots if int(slot.split(':')[0]) < 15]
-    
+class DayTemplate:
+    """Compiled slot grid of one date: bitmask of the slots it is open"""
 
+    __slots__ = ("mask",)
 
+    def __init__(self, mask):
+        self.mask = mask
 
-    # Get booked slots for this date
-    target_date = selected_date.strftime('%Y-%m-%d')
-    
-    # Filter reservations for the selected date
-    date_mask = reservas_df['Fecha'].astype(str).str.contains(target_date, na=False)
-    booked_hours = reservas_df[date_mask]['Hora'].tolist()
-    
-    # Parse booked slots (handles combined slots)
-    booked_slots = parse_booked_slots(booked_hours)
-    
-    if numero_bultos >= 8:
-        # For 8+ bultos, find contiguous 60-minute slots (3 x 20 minutes)
-        return find_contiguous_slots(all_20min_slots, booked_slots, 3)
-    elif numero_bultos >= 4:
-        # For 4-7 bultos, find contiguous 40-minute slots (2 x 20 minutes)
-        return find_contiguous_slots(all_20min_slots, booked_slots, 2)
-    else:
-        # For 1-3 bultos, return available 20-minute slots
-        return [slot for slot in all_20min_slots if slot not in booked_slots]
+
+class WorkCalendar:
+    """Opening hours by rule, compiled once per date into a DayTemplate.
+
+    Rules, most specific first: special_days (date -> hours, "" = closed),
+    holidays (closed), weekly (weekday key -> hours; missing = closed).
+    The slot grid starts at the earliest opening time of any rule.
+    """
+
+    def __init__(self, weekly, holidays=(), special_days=None, slot_minutes=20):
+        self.slot_minutes = int(slot_minutes)
+        self._weekly = {WEEKDAY_KEYS.index(key): parse_hours_range(hours) for key, hours in weekly.items()}
+        self._holidays = {date.fromisoformat(str(day)[:10]).toordinal() for day in holidays}
+        self._special = {date.fromisoformat(str(day)[:10]).toordinal(): parse_hours_range(hours)
+                         for day, hours in (special_days or {}).items()}
+        ranges = [hours for hours in [*self._weekly.values(), *self._special.values()] if hours]
+        self.day_start = min((opens for opens, _ in ranges), default=9 * 60)
+        day_end = max((closes for _, closes in ranges), default=self.day_start)
+        self.grid_size = max(1, (day_end - self.day_start) // self.slot_minutes)
+        if self.grid_size > 62:
+            raise ValueError(f"Work calendar spans {self.grid_size} slots; at most 62 fit a day mask")
+        for opens, _ in ranges:
+            if (opens - self.day_start) % self.slot_minutes:
+                raise ValueError(f"Opening time {opens // 60:d}:{opens % 60:02d} is off the {self.slot_minutes}-minute grid")
+        self._templates = {}
+
+    @classmethod
+    def from_config(cls, config):
+        merged = {**DEFAULT_WORK_CALENDAR, **config}
+        return cls(merged["weekly"], merged["holidays"], merged["special_days"], merged["slot_minutes"])
+
+    def hours(self, day):
+        """(open, close) minutes for a date, or None if closed"""
+        ordinal = day.toordinal()
+        if ordinal in self._special:
+            return self._special[ordinal]
+        if ordinal in self._holidays:
+            return None
+        return self._weekly.get(day.weekday())
+
+    def template(self, day):
+        ordinal = day.toordinal()
+        template = self._templates.get(ordinal)
+        if template is None:
+            template = self._templates[ordinal] = self._compile(day)
+        return template
+
+    def _compile(self, day):
+        hours = self.hours(day)
+        if hours is None:
+            return DayTemplate(0)
+        opens, closes = hours
+        mask = 0
+        for minutes in range(opens, closes - self.slot_minutes + 1, self.slot_minutes):
+            mask |= 1 << (minutes - self.day_start) // self.slot_minutes
+        return DayTemplate(mask)
+
+
+CALENDAR = WorkCalendar.from_config(WORK_CALENDAR)
+
+def get_day_template(selected_date):
+    """Precomputed slot template for a date (mask 0 on closed days)"""
+    return CALENDAR.template(selected_date)
+
+# Slot grid: bit i of an occupancy mask = slot starting at day_start + i*slot_minutes
+SLOT_MINUTES = CALENDAR.slot_minutes
+DAY_START_MINUTES = CALENDAR.day_start
+
+def slot_index(slot_time):
+    """'9:20' or '9:20:00' -> position on the 20-minute slot grid (0 = 9:00)"""
+    parts = str(slot_time).strip().split(':')
+    return (int(parts[0]) * 60 + int(parts[1]) - DAY_START_MINUTES) // SLOT_MINUTES
+
+def slot_label(index):
+    """Slot grid position -> 'H:MM'"""
+    minutes = DAY_START_MINUTES + index * SLOT_MINUTES
+    return f"{minutes // 60:d}:{minutes % 60:02d}"
+
+def slots_to_mask(slots):
+    """Iterable of 'H:MM' slots -> bitmask"""
+    mask = 0
+    for slot in slots:
+        index = slot_index(slot)
+        if index >= 0:
+            mask |= 1 << index
+    return mask
+
+def occupancy_mask(booked_hours):
+    """Hora values (single or comma-joined) -> bitmask of booked slots"""
+    return slots_to_mask(parse_booked_slots(booked_hours))
+
+def parse_anden(anden):
+    """Anden cell -> dock number (1 for rows written before docks were recorded)"""
+    try:
+        return max(1, int(float(str(anden).strip() or 1)))
+    except ValueError:
+        return 1
+
+def build_dock_masks(rows):
+    """(Hora, Anden) pairs -> [booked mask of dock 1 .. DOCK_COUNT]"""
+    masks = [0] * DOCK_COUNT
+    for hora, anden in rows:
+        dock = parse_anden(anden)
+        if dock <= DOCK_COUNT:
+            masks[dock - 1] |= occupancy_mask([hora])
+    return masks
+
+def run_mask(start_index, slots_needed):
+    """Bitmask covering slots_needed consecutive slots from start_index"""
+    return ((1 << slots_needed) - 1) << start_index
+
+def contiguous_starts(free_mask, slots_needed):
+    """Bits set where a run of slots_needed free slots starts"""
+    starts = free_mask
+    for k in range(1, slots_needed):
+        starts &= free_mask >> k
+    return starts
+
+def window_starts(template_mask, dock_masks, slots_needed):
+    """Bits where at least one dock has slots_needed free template slots in a row"""
+    starts = 0
+    for dock_mask in dock_masks:
+        starts |= contiguous_starts(template_mask & ~dock_mask, slots_needed)
+    return starts
+
+def mask_bits(mask):
+    """Yield the set bit positions of mask in ascending order"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def parse_fecha_ordinal(fecha):
+    """'YYYY-MM-DD[ 0:00:00]', date or ordinal -> date ordinal (0 if unparseable)"""
+    if isinstance(fecha, int):
+        return fecha
+    if hasattr(fecha, 'toordinal'):
+        return fecha.toordinal()
+    try:
+        return date.fromisoformat(str(fecha).strip().split(' ')[0]).toordinal()
+    except ValueError:
+        return 0
+
+def parse_hora(hora):
+    """Hora value (single or comma-joined slots) -> (start slot index, slot count); (-1, 0) if empty"""
+    indexes = [index for index in (slot_index(slot) for slot in parse_booked_slots([hora])) if index >= 0]
+    if not indexes:
+        return -1, 0
+    start = min(indexes)
+    return start, max(indexes) - start + 1
+
+def parse_ordenes(ordenes):
+    """'123, 456' -> ('123', '456')"""
+    return tuple(orden.strip() for orden in str(ordenes).split(',') if orden.strip() and orden.strip().lower() != 'nan')
+
+def parse_bultos(bultos):
+    try:
+        return int(float(str(bultos).strip() or 0))
+    except ValueError:
+        return 0
+
+
+class ReservationRecords:
+    """Typed reservas rows parsed once per snapshot, in parallel compact arrays.
+
+    Row i: fecha[i] date ordinal, start[i] first slot index, slots[i] slot
+    count, dock[i] dock number, bultos[i] int, proveedor[i] str, ordenes[i]
+    tuple of POs. Cancelled rows get no slots and no POs, so no index sees them.
+    Row positions match the snapshot DataFrame, which is kept for display only.
+    Incremental snapshots share the arrays: a snapshot sees its first
+    len(records) rows, and later rows may follow them.
+    """
+
+    __slots__ = ('fecha', 'start', 'slots', 'dock', 'bultos', 'proveedor', 'ordenes', '_limit')
+
+    def __init__(self):
+        self.fecha = array('l')
+        self.start = array('h')
+        self.slots = array('h')
+        self.dock = array('h')
+        self.bultos = array('l')
+        self.proveedor = []
+        self.ordenes = []
+        self._limit = 0  # rows of this snapshot
+
+    def __len__(self):
+        return self._limit
+
+    def copy(self):
+        """Unshared copy of this snapshot's rows"""
+        n = self._limit
+        records = ReservationRecords()
+        records.fecha.extend(self.fecha[:n])
+        records.start.extend(self.start[:n])
+        records.slots.extend(self.slots[:n])
+        records.dock.extend(self.dock[:n])
+        records.bultos.extend(self.bultos[:n])
+        records.proveedor.extend(self.proveedor[:n])
+        records.ordenes.extend(self.ordenes[:n])
+        records._limit = n
+        return records
+
+    def extended(self, reservas_df):
+        """These rows plus reservas_df's, appended in place unless a newer snapshot already extended the arrays"""
+        if len(self.fecha) != self._limit:
+            return self.copy().append_frame(reservas_df)
+        records = ReservationRecords.__new__(ReservationRecords)
+        for name in ('fecha', 'start', 'slots', 'dock', 'bultos', 'proveedor', 'ordenes'):
+            setattr(records, name, getattr(self, name))
+        records._limit = self._limit
+        return records.append_frame(reservas_df)
+
+    def append_frame(self, reservas_df):
+        """Parse and append every row of reservas_df"""
+        n = len(reservas_df)
+        empty = [''] * n
+        columns = [reservas_df[col].tolist() if col in reservas_df.columns else empty for col in RESERVAS_COLUMNS]
+        for fecha, hora, proveedor, bultos, ordenes, anden, estado in zip(*columns):
+            start, slots = parse_hora(hora)
+            if str(estado).strip() == ESTADO_CANCELADA:
+                slots, ordenes = 0, ''
+            self.fecha.append(parse_fecha_ordinal(fecha))
+            self.start.append(start)
+            self.slots.append(slots)
+            self.dock.append(parse_anden(anden))
+            self.bultos.append(parse_bultos(bultos))
+            self.proveedor.append(sys.intern(str(proveedor).strip()))
+            self.ordenes.append(parse_ordenes(ordenes))
+        self._limit = len(self.fecha)
+        return self
+
+
+class SnapshotDerived:
+    """Structure derived from a table snapshot, built once per snapshot_id.
+
+    Snapshots produced by incremental sync (parent_snapshot / parent_rows
+    attrs) are built by extending the parent's structure with the new rows,
+    which may update the parent's storage in place; extensions therefore
+    run one at a time.
+    """
+
+    def __init__(self, build, extend, max_entries=4):
+        self._build = build      # (reservas_df) -> structure
+        self._extend = extend    # (parent structure, reservas_df, first new row) -> structure
+        self._max_entries = max_entries
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._extend_lock = threading.Lock()
+
+    def get(self, reservas_df):
+        snapshot_id = reservas_df.attrs.get('snapshot_id')
+        with self._lock:
+            value = self._cache.get(snapshot_id)
+            parent = self._cache.get(reservas_df.attrs.get('parent_snapshot'))
+        if value is not None:
+            return value
+        if parent is not None:
+            with self._extend_lock:
+                with self._lock:
+                    value = self._cache.get(snapshot_id)
+                if value is not None:
+                    return value
+                value = self._extend(parent, reservas_df, reservas_df.attrs['parent_rows'])
+        else:
+            value = self._build(reservas_df)
+        if snapshot_id is not None:
+            with self._lock:
+                if len(self._cache) >= self._max_entries:
+                    self._cache.pop(next(iter(self._cache)))
+                self._cache[snapshot_id] = value
+        return value
+
+
+_reservation_records = SnapshotDerived(
+    build=lambda df: ReservationRecords().append_frame(df),
+    extend=lambda parent, df, first: parent.extended(df.iloc[first:])
+)
+
+def get_reservation_records(reservas_df):
+    """ReservationRecords for this reservas snapshot"""
+    return _reservation_records.get(reservas_df)
+
+
+class OccupancyIndex:
+    """Booked-slot bitmask per day and dock ((date ordinal, dock) -> int), built once per reservas snapshot.
+
+    Incremental snapshots OR their new rows into the same masks, so an older
+    snapshot's index also shows the bookings appended after it (never fewer).
+    """
+
+    __slots__ = ('_masks', '_end')
+
+    def __init__(self, records):
+        self._masks = {}
+        self._end = [0]  # rows in the shared masks, shared with the extended indexes
+        self._add(records, 0)
+
+    def _add(self, records, first):
+        masks = self._masks
+        for position in range(first, len(records)):
+            slots = records.slots[position]
+            if slots:
+                key = (records.fecha[position], records.dock[position])
+                masks[key] = masks.get(key, 0) | run_mask(records.start[position], slots)
+        self._end[0] = len(records)
+
+    def extended(self, records, first):
+        """This index plus records[first:]; updated in place unless a newer snapshot already extended it"""
+        index = OccupancyIndex.__new__(OccupancyIndex)
+        if self._end[0] == first:
+            index._masks, index._end = self._masks, self._end
+        else:
+            index._masks, index._end = dict(self._masks), [first]
+        index._add(records, first)
+        return index
+
+    def dock_masks(self, day):
+        """[booked mask of dock 1 .. DOCK_COUNT] for a date, 'YYYY-MM-DD' string or ordinal"""
+        ordinal = parse_fecha_ordinal(day)
+        return [self._masks.get((ordinal, dock), 0) for dock in range(1, DOCK_COUNT + 1)]
+
+
+_occupancy_indexes = SnapshotDerived(
+    build=lambda df: OccupancyIndex(get_reservation_records(df)),
+    extend=lambda parent, df, first: parent.extended(get_reservation_records(df), first)
+)
+
+def get_occupancy_index(reservas_df):
+    """OccupancyIndex for this reservas snapshot (keyed by the snapshot_id set at load)"""
+    return _occupancy_indexes.get(reservas_df)
+
+class PurchaseOrderIndex:
+    """Orden_de_compra -> [row positions of the bookings that include it], built once per reservas snapshot"""
+
+    __slots__ = ('_rows', '_end', '_limit')
+
+    def __init__(self, records):
+        self._rows = {}
+        self._end = [0]  # rows in the shared dict, shared with the extended indexes
+        self._limit = 0  # rows of this snapshot
+        self._add(records, 0)
+
+    def _add(self, records, first):
+        rows = self._rows
+        for position in range(first, len(records)):
+            for orden in records.ordenes[position]:
+                rows.setdefault(orden, []).append(position)
+        self._end[0] = self._limit = len(records)
+
+    def extended(self, records, first):
+        """This index plus records[first:]; updated in place unless a newer snapshot already extended it"""
+        index = PurchaseOrderIndex.__new__(PurchaseOrderIndex)
+        if self._end[0] == first:
+            index._rows, index._end = self._rows, self._end
+        else:
+            index._rows, index._end = {}, [first]
+            for orden, positions in self._rows.items():
+                kept = [position for position in positions if position < first]
+                if kept:
+                    index._rows[orden] = kept
+        index._add(records, first)
+        return index
+
+    def bookings(self, orden):
+        """Row positions booked for a PO in this snapshot (empty tuple if none)"""
+        return tuple(position for position in self._rows.get(str(orden).strip(), ()) if position < self._limit)
+
+
+_purchase_order_indexes = SnapshotDerived(
+    build=lambda df: PurchaseOrderIndex(get_reservation_records(df)),
+    extend=lambda parent, df, first: parent.extended(get_reservation_records(df), first)
+)
+
+def get_purchase_order_index(reservas_df):
+    """PurchaseOrderIndex for this reservas snapshot"""
+    return _purchase_order_indexes.get(reservas_df)
+
+def find_booked_orders(reservas_df, ordenes):
+    """{orden: ('dd/mm/YYYY', 'H:MM')} of the first existing booking of each already-booked PO"""
+    records = get_reservation_records(reservas_df)
+    index = get_purchase_order_index(reservas_df)
+    booked = {}
+    for orden in ordenes:
+        positions = index.bookings(orden)
+        if positions:
+            position = positions[0]
+            fecha = records.fecha[position]
+            start = records.start[position]
+            booked[orden] = (
+                date.fromordinal(fecha).strftime('%d/%m/%Y') if fecha else '',
+                slot_label(start) if start >= 0 else ''
+            )
+    return booked
+
+class RowLocator:
+    """(date ordinal, start slot, dock, proveedor) -> (row key, snapshot position), built once per reservas snapshot.
+
+    Row keys come from the snapshot index: sheet row numbers for Sheets,
+    row ids for SQLite.
+    """
+
+    __slots__ = ('_rows', '_by_supplier', '_end', '_limit')
+
+    def __init__(self, records, row_keys):
+        self._rows = {}
+        self._by_supplier = {}
+        self._end = [0]  # rows in the shared dicts, shared with the extended locators
+        self._limit = 0  # rows of this snapshot
+        self._add(records, row_keys, 0)
+
+    def _add(self, records, row_keys, first):
+        for position in range(first, len(records)):
+            if records.slots[position]:
+                proveedor = records.proveedor[position]
+                key = (records.fecha[position], records.start[position], records.dock[position], proveedor)
+                self._rows[key] = (int(row_keys[position]), position)
+                self._by_supplier.setdefault(proveedor, []).append(key)
+        self._end[0] = self._limit = len(records)
+
+    def extended(self, records, row_keys, first):
+        """This locator plus records[first:]; updated in place unless a newer snapshot already extended it"""
+        locator = RowLocator.__new__(RowLocator)
+        if self._end[0] == first:
+            locator._rows, locator._by_supplier, locator._end = self._rows, self._by_supplier, self._end
+        else:
+            locator._rows = {key: hit for key, hit in self._rows.items() if hit[1] < first}
+            locator._by_supplier = {supplier: [key for key in keys if key in locator._rows]
+                                    for supplier, keys in self._by_supplier.items()}
+            locator._end = [first]
+        locator._add(records, row_keys, first)
+        return locator
+
+    def _visible(self, key):
+        hit = self._rows.get(key)
+        return hit if hit is not None and hit[1] < self._limit else None
+
+    def locate(self, day, slot_time, dock, proveedor):
+        """(row key, position) of a booking in this snapshot, or None"""
+        return self._visible((parse_fecha_ordinal(day), slot_index(slot_time), int(dock), str(proveedor).strip()))
+
+    def supplier_bookings(self, proveedor):
+        """[(date ordinal, start slot, dock, proveedor)] of a supplier's bookings, in date/slot/dock order"""
+        return sorted({key for key in self._by_supplier.get(str(proveedor).strip(), ()) if self._visible(key)})
+
+
+_row_locators = SnapshotDerived(
+    build=lambda df: RowLocator(get_reservation_records(df), df.index),
+    extend=lambda parent, df, first: parent.extended(get_reservation_records(df), df.index, first)
+)
+
+def get_row_locator(reservas_df):
+    """RowLocator for this reservas snapshot"""
+    return _row_locators.get(reservas_df)
+
+def normalize_snapshot(table, df):
+    """Loader post-processing: build each snapshot's lookup index once, off the request path"""
+    if table == RESERVAS_TABLE:
+        get_occupancy_index(df)
+        get_purchase_order_index(df)
+        get_row_locator(df)
+    elif table == CREDENCIAL_TABLE:
+        get_credential_index(df)
+
+def find_contiguous_slots(template_mask, dock_masks, slots_needed):
+    """Starts where some dock is free for slots_needed contiguous slots"""
+    available = window_starts(template_mask, dock_masks, slots_needed)
+    return [slot_label(i) for i in mask_bits(available)]
+
+def get_slot_availability(template_mask, dock_masks, slots_needed):
+    """[(start_slot, is_available)] for every start that fits slots_needed slots of the template"""
+    possible = contiguous_starts(template_mask, slots_needed)
+    available = window_starts(template_mask, dock_masks, slots_needed)
+    return [(slot_label(i), bool(available >> i & 1)) for i in mask_bits(possible)]
+
+DIAS_SEMANA = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
+
+SLOT_GRID_SIZE = CALENDAR.grid_size  # bits per day mask
+
+def parse_duration_rules(spec):
+    """"1:20,4:40,8:60" or [[1, 20], [4, 40], [8, 60]] -> [(min_bultos, minutes)] sorted by min_bultos"""
+    if isinstance(spec, str):
+        spec = [step.split(':') for step in spec.split(',') if step.strip()]
+    rules = sorted((int(min_bultos), int(minutes)) for min_bultos, minutes in spec)
+    if not rules or any(minutes <= 0 for _, minutes in rules):
+        raise ValueError(f"Invalid BOOKING_DURATIONS: {spec!r}")
+    return rules
+
+DURATION_RULES = parse_duration_rules(BOOKING_DURATIONS)
+
+def booking_minutes(numero_bultos):
+    """Configured delivery duration (minutes) for a number of bultos"""
+    minutes = DURATION_RULES[0][1]
+    for min_bultos, rule_minutes in DURATION_RULES:
+        if numero_bultos >= min_bultos:
+            minutes = rule_minutes
+    return minutes
+
+def slots_needed_for(numero_bultos):
+    """Whole grid slots a delivery of numero_bultos occupies"""
+    return -(-booking_minutes(numero_bultos) // SLOT_MINUTES)
+
+def duration_rules_text():
+    """'1-3 bultos = 20 minutos, 4-7 bultos = 40 minutos y 8+ bultos = 60 minutos'"""
+    parts = []
+    for position, (min_bultos, _) in enumerate(DURATION_RULES):
+        minutes = slots_needed_for(min_bultos) * SLOT_MINUTES
+        if position + 1 < len(DURATION_RULES):
+            parts.append(f"{max(min_bultos, 1)}-{DURATION_RULES[position + 1][0] - 1} bultos = {minutes} minutos")
+        else:
+            parts.append(f"{max(min_bultos, 1)}+ bultos = {minutes} minutos")
+    return parts[0] if len(parts) == 1 else ", ".join(parts[:-1]) + " y " + parts[-1]
+
+# Slot counts of the configured durations (one availability layer each)
+DURATION_CLASSES = tuple(sorted({slots_needed_for(min_bultos) for min_bultos, _ in DURATION_RULES}))
+
+def availability_matrix(start_date, days, occupancy):
+    """(days x slots) availability for every duration class, computed in one NumPy pass.
+
+    Returns (dates, {slots_needed: bool array}) where [d, i] is True if a
+    booking of that class can start at slot i on dates[d] on at least one dock.
+    """
+    dates = [start_date + timedelta(days=n) for n in range(days)]
+    templates = np.array([get_day_template(d).mask for d in dates], dtype=np.int64)
+    booked = np.array([occupancy.dock_masks(d) for d in dates], dtype=np.int64).reshape(days, DOCK_COUNT)
+    bits = np.arange(SLOT_GRID_SIZE, dtype=np.int64)
+    # free[d, k, i]: slot i of dock k is open and unbooked on dates[d]
+    free = (((templates[:, None] & ~booked)[:, :, None] >> bits) & 1).astype(bool)
+
+    windows = {}
+    for slots_needed in DURATION_CLASSES:
+        starts = np.zeros_like(free)
+        if slots_needed > SLOT_GRID_SIZE:
+            windows[slots_needed] = starts.any(axis=1)
+            continue
+        starts[:, :, :SLOT_GRID_SIZE - slots_needed + 1] = sliding_window_view(free, slots_needed, axis=2).all(axis=3)
+        windows[slots_needed] = starts.any(axis=1)
+    return dates, windows
+
+def first_available_slot(dates, starts):
+    """(date, 'H:MM') of the earliest True cell in an availability matrix, or (None, None)"""
+    days, slots = np.nonzero(starts)
+    if len(days) == 0:
+        return None, None
+    return dates[days[0]], slot_label(int(slots[0]))
 
 # ─────────────────────────────────────────────────────────────
 # 5. Authentication Function - UPDATED FOR GOOGLE SHEETS
 # ─────────────────────────────────────────────────────────────
+def parse_cc_emails(cc_data):
+    """Semicolon-separated cc cell -> list of emails"""
+    if cc_data is None or str(cc_data) == 'nan':
+        return []
+    return [email.strip() for email in str(cc_data).split(';') if email.strip()]
+
+
+class CredentialEntry:
+    """One proveedor_credencial row with its email fields already parsed"""
+
+    __slots__ = ('usuario', 'password', 'email', 'cc_emails')
+
+    def __init__(self, usuario, password, email, cc_emails):
+        self.usuario = usuario
+        self.password = password
+        self.email = email
+        self.cc_emails = cc_emails
+
+
+class CredentialIndex:
+    """Normalized usuario -> CredentialEntry, built once per credentials snapshot"""
+
+    __slots__ = ('_entries',)
+
+    def __init__(self, credentials_df):
+        self._entries = {}
+        n = len(credentials_df)
+        empty = [None] * n
+        columns = [credentials_df[col].tolist() if col in credentials_df.columns else empty
+                   for col in CREDENCIAL_COLUMNS]
+        for usuario, password, email, cc_data in zip(*columns):
+            key = str(usuario).strip()
+            if str(email) == 'nan' or not str(email or '').strip():
+                email = None
+            # First row wins for duplicated users
+            self._entries.setdefault(key, CredentialEntry(
+                key, str(password).strip().encode(), email, parse_cc_emails(cc_data)
+            ))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, usuario):
+        return self._entries.get(str(usuario).strip())
+
+
+_credential_indexes = SnapshotDerived(
+    build=CredentialIndex,
+    extend=lambda parent, df, first: CredentialIndex(df)
+)
+
+def get_credential_index(credentials_df):
+    """CredentialIndex for this credentials snapshot"""
+    return _credential_indexes.get(credentials_df)
+
+@st.cache_resource
+def prefetch_startup_tables():
+    """Load what login and the booking page need in one batched request, in the background (once per process).
+
+    Login and the first booking page then wait on this fetch instead of starting their own.
+    """
+    def run():
+        try:
+            get_table_cache().get_many([CREDENCIAL_TABLE, RESERVAS_TABLE])
+        except Exception as e:
+            log_booking_attempt("PREFETCH_FAILED", f"{CREDENCIAL_TABLE}, {RESERVAS_TABLE}", error=str(e))
+    thread = threading.Thread(target=run, name="startup-prefetch", daemon=True)
+    thread.start()
+    return thread
+
 def authenticate_user(usuario, password):
-    """Authenticate user against Google Sheets data and get email + CC emails"""
-    credentials_df, _, _ = download_sheets_to_memory()
+    """Authenticate user against the credentials snapshot and get email + CC emails"""
+    credentials_df = load_table(CREDENCIAL_TABLE)
     
     if credentials_df is None:
         return False, "Error al cargar credenciales", None, None
     
-    # Clean and compare (all data is already strings)
-    df_usuarios = credentials_df['usuario'].str.strip()
-    
-    input_usuario = str(usuario).strip()
-    input_password = str(password).strip()
-    
-    # Find user row
-    user_row = credentials_df[df_usuarios == input_usuario]
-    if user_row.empty:
+    entry = get_credential_index(credentials_df).get(usuario)
+    if entry is None:
         return False, "Usuario no encontrado", None, None
     
-    # Get stored password and clean it
-    stored_password = str(user_row.iloc[0]['password']).strip()
-    
-    # Compare passwords
-    if stored_password == input_password:
-        # Get email
-        email = None
-        try:
-            email = user_row.iloc[0]['Email']
-            if str(email) == 'nan' or email is None:
-                email = None
-        except:
-            email = None
-        
-        # Get CC emails
-        cc_emails = []
-        try:
-            cc_data = user_row.iloc[0]['cc']
-            if str(cc_data) != 'nan' and cc_data is not None and str(cc_data).strip():
-                # Parse semicolon-separated emails
-                cc_emails = [email.strip() for email in str(cc_data).split(';') if email.strip()]
-        except Exception as e:
-            cc_emails = []
-        
-        return True, "Autenticación exitosa", email, cc_emails
+    # Constant-time comparison of the stripped passwords
+    if hmac.compare_digest(entry.password, str(password).strip().encode()):
+        return True, "Autenticación exitosa", entry.email, list(entry.cc_emails)
     
     return False, "Contraseña incorrecta", None, None
 
@@ -820,72 +3655,134 @@ def authenticate_user(usuario, password):
 # 6. Fresh slot validation function - MODIFIED FOR 20-MINUTE SLOTS
 # ─────────────────────────────────────────────────────────────
 def check_slot_availability(selected_date, slot_time, numero_bultos):
-    """Check if a specific slot is still available with fresh data from Google Sheets"""
+    """Check if a specific slot is still available with fresh data from the storage backend"""
     try:
-        # Force fresh download
-        download_sheets_to_memory.clear()
-        _, fresh_reservas_df, _ = download_sheets_to_memory()
-        
-        if fresh_reservas_df is None:
-            return False, "Error al verificar disponibilidad"
-        
-        # Get booked slots for this date
+        # Recent snapshot's occupancy index (indexed query on SQLite)
         target_date = selected_date.strftime('%Y-%m-%d')
-        date_mask = fresh_reservas_df['Fecha'].astype(str).str.contains(target_date, na=False)
-        booked_hours = fresh_reservas_df[date_mask]['Hora'].tolist()
+        dock_masks = get_storage().dock_masks(target_date)
+        start = slot_index(slot_time)
         
-        # Parse booked slots (handles combined slots)
-        booked_slots = parse_booked_slots(booked_hours)
+        def dock_free(slots_needed):
+            return any(not dock_mask & run_mask(start, slots_needed) for dock_mask in dock_masks)
         
-        if numero_bultos >= 8:
-            # For 8+ bultos, check current and next 2 slots (60 minutes)
-            slot1 = slot_time
-            slot2 = get_next_slot(slot1)
-            slot3 = get_next_slot(slot2)
-            
-            if slot1 in booked_slots:
-                return False, "Otro proveedor acaba de reservar este horario. Por favor, elija otro."
-            if slot2 in booked_slots:
-                return False, "Uno de los horarios necesarios para su reserva de 60 minutos ya está ocupado."
-            if slot3 in booked_slots:
-                return False, "Uno de los horarios necesarios para su reserva de 60 minutos ya está ocupado."
-                
-        elif numero_bultos >= 4:
-            # For 4-7 bultos, check current and next slot (40 minutes)
-            slot1 = slot_time
-            slot2 = get_next_slot(slot1)
-            
-            if slot1 in booked_slots:
-                return False, "Otro proveedor acaba de reservar este horario. Por favor, elija otro."
-            if slot2 in booked_slots:
-                return False, "El horario siguiente necesario para su reserva de 40 minutos ya está ocupado."
-        else:
-            # For 1-3 bultos, check only current slot (20 minutes)
-            if slot_time in booked_slots:
-                return False, "Otro proveedor acaba de reservar este horario. Por favor, elija otro."
+        # Requested slot itself
+        if not dock_free(1):
+            return False, "Otro proveedor acaba de reservar este horario. Por favor, elija otro."
+        
+        # Longer deliveries also need the following slots on the same dock
+        slots_needed = slots_needed_for(numero_bultos)
+        if slots_needed > 1 and not dock_free(slots_needed):
+            return False, f"Uno de los horarios necesarios para su reserva de {slots_needed * SLOT_MINUTES} minutos ya está ocupado."
         
         return True, "Horario disponible"
         
     except Exception as e:
-        return False, f"Error verificando disponibilidad: {str(e)}"
+        log_booking_attempt("AVAILABILITY_CHECK_ERROR", f"{selected_date} {slot_time}", success=False, error=str(e))
+        return False, "No se pudo verificar la disponibilidad del horario. Intente nuevamente en unos momentos."
 
 # ─────────────────────────────────────────────────────────────
 # 7. Main App - MODIFIED FOR 20-MINUTE SLOTS
 # ─────────────────────────────────────────────────────────────
-def main():
-    st.title("🚚 Dismac: Reserva de Entrega de Mercadería")
+def manage_bookings_section(reservas_df, supplier_name):
+    """Upcoming bookings of the logged-in supplier, with cancel / reschedule up to the day before"""
+    locator = get_row_locator(reservas_df)
+    today = datetime.now().date()
+    read_only = storage_read_only()
+    upcoming = [key for key in locator.supplier_bookings(supplier_name) if key[0] >= today.toordinal()]
     
-    # Download Google Sheets data when app starts
-    with st.spinner("Cargando datos..."):
-        credentials_df, reservas_df, gestion_df = download_sheets_to_memory()
+    if not upcoming:
+        st.write("No tiene reservas próximas.")
+        return
     
-    if credentials_df is None:
-        st.error("❌ Error al cargar datos")
-        if st.button("🔄 Reintentar Conexión"):
-            download_sheets_to_memory.clear()
+    for fecha, start, dock, proveedor in upcoming:
+        row_key, position = locator.locate(fecha, slot_label(start), dock, proveedor)
+        current = {col: str(value) for col, value in reservas_df.iloc[position].items()}
+        booking_date = date.fromordinal(fecha)
+        _, num_slots = parse_hora(current['Hora'])
+        slot_key = f"{fecha}_{start}_{dock}"
+        
+        col1, col2, col3 = st.columns([4, 1, 1])
+        with col1:
+            st.write(
+                f"📅 {DIAS_SEMANA[booking_date.weekday()]} {booking_date.strftime('%d/%m/%Y')} · "
+                f"🕐 {slot_label(start)} - {slot_label(start + num_slots)} · "
+                f"📦 {current['Numero_de_bultos']} · 📋 {current['Orden_de_compra']}"
+            )
+        if booking_date <= today or read_only:
+            continue
+        with col2:
+            if st.button("🔁 Reprogramar", key=f"reschedule_{slot_key}", use_container_width=True):
+                st.session_state.reschedule_key = slot_key
+        with col3:
+            if st.button("❌ Cancelar", key=f"cancel_{slot_key}", use_container_width=True):
+                try:
+                    cancel_booking(get_storage(), row_key, current)
+                    log_booking_attempt("CANCEL_COMPLETE", f"{supplier_name} {current['Fecha']} {current['Hora']}", success=True)
+                    st.session_state.booking_notice = "✅ Reserva cancelada"
+                except BookingNotFoundError as e:
+                    log_booking_attempt("CANCEL_STALE", supplier_name, success=False, error=str(e))
+                    st.session_state.booking_notice = "⚠️ La reserva cambió mientras tanto. Revise sus reservas."
+                    invalidate_tables(RESERVAS_TABLE)
+                except Exception as e:
+                    log_booking_attempt("CANCEL_FAILED", supplier_name, success=False, error=str(e))
+                    st.session_state.booking_notice = "❌ No se pudo cancelar la reserva. Intente nuevamente en unos minutos."
+                st.rerun()
+        
+        if st.session_state.get('reschedule_key') != slot_key:
+            continue
+        
+        # Reschedule: same duration, any free window from tomorrow on (own slots count as free)
+        numero_bultos = parse_bultos(current['Numero_de_bultos'])
+        slots_needed = num_slots or slots_needed_for(numero_bultos)
+        occupancy = get_occupancy_index(reservas_df)
+        new_dates = [today + timedelta(days=n) for n in range(1, 31)]
+        new_date = st.selectbox(
+            "Nueva fecha",
+            new_dates,
+            format_func=lambda d: f"{DIAS_SEMANA[d.weekday()]} {d.strftime('%d/%m/%Y')}",
+            key=f"reschedule_date_{slot_key}"
+        )
+        dock_masks = occupancy.dock_masks(new_date)
+        if new_date == booking_date:
+            own_dock = parse_anden(current.get('Anden'))
+            if own_dock <= DOCK_COUNT:
+                dock_masks[own_dock - 1] &= ~run_mask(start, num_slots)
+        free_starts = find_contiguous_slots(get_day_template(new_date).mask, dock_masks, slots_needed)
+        if not free_starts:
+            st.warning("❌ No hay horarios disponibles para esta fecha")
+            continue
+        new_slot = st.selectbox("Nuevo horario", free_starts, key=f"reschedule_slot_{slot_key}")
+        
+        if st.button("✅ Confirmar cambio", key=f"reschedule_confirm_{slot_key}"):
+            new_start = slot_index(new_slot)
+            booking = dict(current,
+                           Fecha=new_date.strftime('%Y-%m-%d') + ' 0:00:00',
+                           Hora=", ".join(f"{slot_label(new_start + k)}:00" for k in range(slots_needed)))
+            try:
+                reschedule_booking(get_storage(), row_key, current, booking)
+                log_booking_attempt("RESCHEDULE_COMPLETE", f"{supplier_name} -> {booking['Fecha']} {booking['Hora']}", success=True)
+                st.session_state.booking_notice = f"✅ Reserva movida al {new_date.strftime('%d/%m/%Y')} a las {new_slot}"
+                st.session_state.reschedule_key = None
+            except SlotTakenError:
+                st.session_state.booking_notice = "❌ Otro proveedor acaba de reservar ese horario. Elija otro."
+                invalidate_tables(RESERVAS_TABLE)
+            except BookingNotFoundError as e:
+                log_booking_attempt("RESCHEDULE_STALE", supplier_name, success=False, error=str(e))
+                st.session_state.booking_notice = "⚠️ La reserva cambió mientras tanto. Revise sus reservas."
+                invalidate_tables(RESERVAS_TABLE)
+            except Exception as e:
+                log_booking_attempt("RESCHEDULE_FAILED", supplier_name, success=False, error=str(e))
+                st.session_state.booking_notice = "❌ No se pudo reprogramar la reserva. Intente nuevamente en unos minutos."
             st.rerun()
-        return
+
+def main():
+    st.title("🚚 Dismac: Reserva de Entrega de Mercadería")
     
+    # Start the outbox worker with the first render, so mail queued before a restart goes out now
+    try:
+        get_email_outbox()
+    except Exception as e:
+        log_booking_attempt("OUTBOX_START_FAILED", MAIL_OUTBOX_PATH, error=str(e))
     
     # Session state - UNCHANGED
     if 'authenticated' not in st.session_state:
@@ -904,6 +3801,8 @@ def main():
     # Authentication - UNCHANGED LOGIC
     if not st.session_state.authenticated:
         st.subheader("🔐 Iniciar Sesión")
+        # The form renders at once; credentials (never in the disk snapshot) download meanwhile
+        prefetch_startup_tables()
         
         with st.form("login_form"):
             usuario = st.text_input("Usuario")
@@ -912,7 +3811,8 @@ def main():
             
             if submitted:
                 if usuario and password:
-                    is_valid, message, email, cc_emails = authenticate_user(usuario, password)
+                    with st.spinner("Verificando credenciales..."):
+                        is_valid, message, email, cc_emails = authenticate_user(usuario, password)
                     
                     if is_valid:
                         st.session_state.authenticated = True
@@ -934,6 +3834,19 @@ def main():
     
     # Main interface after authentication
     else:
+        with st.spinner("Cargando reservas..."):
+            reservas_df = load_table(RESERVAS_TABLE)
+        if reservas_df is None:
+            if st.button("🔄 Reintentar Conexión"):
+                invalidate_tables(RESERVAS_TABLE)
+                st.rerun()
+            return
+        
+        read_only = storage_read_only()
+        if read_only:
+            st.warning("⚠️ Sin conexión con el sistema de reservas. Puede consultar la disponibilidad, "
+                       "pero las reservas y cambios están deshabilitados hasta que se restablezca.")
+        
         col1, col2 = st.columns([3, 1])
         with col1:
             st.subheader(f"Bienvenido, {st.session_state.supplier_name}")
@@ -951,13 +3864,20 @@ def main():
                     del st.session_state.selected_slot
                 st.rerun()
         
+        # Existing bookings: cancel / reschedule
+        if st.session_state.get('booking_notice'):
+            st.info(st.session_state.booking_notice)
+            st.session_state.booking_notice = None
+        with st.expander("📋 Mis reservas", expanded=bool(st.session_state.get('reschedule_key'))):
+            manage_bookings_section(reservas_df, st.session_state.supplier_name)
+        
         st.markdown("---")
         
         # STEP 1: Delivery Information - MODIFIED INFO MESSAGE
         st.subheader("📦 Información de Entrega")
         st.markdown('<p style="color: red; font-size: 14px; margin-top: -10px;">Esta aplicación permite programar entregas <strong>exclusivamente de pedidos Marketplace</strong>.<br>Las compras locales o corporativas deben coordinarse directamente con el almacén.</p>', unsafe_allow_html=True)        
         # Show permanent information about time slot durations - MODIFIED FOR 20-MINUTE SLOTS
-        st.info("ℹ️ **La duración del horario de reserva dependerá de la cantidad de bultos:** 1-3 bultos = 20 minutos, 4-7 bultos = 40 minutos y 8+ bultos = 60 minutos")
+        st.info(f"ℹ️ **La duración del horario de reserva dependerá de la cantidad de bultos:** {duration_rules_text()}")
         
         # Number of bultos (MANDATORY, NO DEFAULT)
         numero_bultos = st.number_input(
@@ -1016,93 +3936,99 @@ def main():
                 st.rerun()
         
         # Check if minimum requirements are met to proceed
-        valid_orders = [orden.strip() for orden in orden_compra_values if orden.strip()]
+        valid_orders = list(dict.fromkeys(orden.strip() for orden in orden_compra_values if orden.strip()))
         can_proceed = numero_bultos and numero_bultos > 0 and valid_orders
         
+        # Orders that already have a delivery booked (checked as they are typed)
+        booked_orders = find_booked_orders(reservas_df, valid_orders)
+        for orden, (fecha, hora) in booked_orders.items():
+            st.error(f"❌ La orden {orden} ya tiene una entrega reservada el {fecha} a las {hora}")
+        
         if not can_proceed:
             st.warning("⚠️ Complete el número de bultos y al menos una orden de compra para continuar.")
             return
+        if booked_orders:
+            st.warning("⚠️ Quite las órdenes que ya tienen una entrega reservada para continuar.")
+            return
         
         st.markdown("---")
         
-        # STEP 2: Date selection - UNCHANGED
+        # STEP 2: Date selection - WITH 30-DAY AVAILABILITY OVERVIEW
         st.subheader("📅 Seleccionar Fecha")
-        st.markdown('<p style="color: red; font-size: 14px; margin-top: -10px;">Le rogamos seleccionar la fecha y el horario con atención, ya que, una vez confirmados, no podrán ser modificados ni cancelados.</p>', unsafe_allow_html=True)
+        st.markdown('<p style="color: red; font-size: 14px; margin-top: -10px;">Le rogamos seleccionar la fecha y el horario con atención. Las reservas solo pueden cancelarse o reprogramarse en "Mis reservas" hasta el día anterior a la entrega.</p>', unsafe_allow_html=True)
         today = datetime.now().date()
-        max_date = today + timedelta(days=30)
         
-        selected_date = st.date_input(
+        # Whole booking window for this duration class in one pass
+        slots_needed = slots_needed_for(numero_bultos)
+        window_dates, windows = availability_matrix(today, 31, get_occupancy_index(reservas_df))
+        free_counts = windows[slots_needed].sum(axis=1)
+        
+        if st.button("⚡ Primer horario disponible", use_container_width=True):
+            first_date, first_slot = first_available_slot(window_dates, windows[slots_needed])
+            if first_date is None:
+                st.session_state.slot_error_message = "No hay horarios disponibles en los próximos 30 días"
+            else:
+                with st.spinner("Verificando disponibilidad..."):
+                    is_available, message = check_slot_availability(first_date, first_slot, numero_bultos)
+                if is_available:
+                    st.session_state.fecha_entrega = first_date
+                    st.session_state.selected_slot = first_slot
+                    st.session_state.slot_error_message = None
+                else:
+                    st.session_state.slot_error_message = message
+                    invalidate_tables(RESERVAS_TABLE)
+            st.rerun()
+        
+        def format_fecha(d):
+            label = f"{DIAS_SEMANA[d.weekday()]} {d.strftime('%d/%m/%Y')}"
+            count = int(free_counts[(d - today).days])
+            if not get_day_template(d).mask:
+                return f"🚫 {label} — Cerrado"
+            if count == 0:
+                return f"🚫 {label} — Completo"
+            return f"✅ {label} — {count} horarios libres"
+        
+        # A date kept from a previous day may have left the window
+        if st.session_state.get('fecha_entrega') not in window_dates:
+            st.session_state.pop('fecha_entrega', None)
+        
+        selected_date = st.selectbox(
             "Fecha de entrega",
-            min_value=today,
-            max_value=max_date,
-            value=today
+            window_dates,
+            format_func=format_fecha,
+            key="fecha_entrega"
         )
         
-        # Check if Sunday
-        if selected_date.weekday() == 6:
-            st.warning("⚠️ No trabajamos los domingos")
+        # Closed days (Sundays, holidays)
+        if not get_day_template(selected_date).mask:
+            if selected_date.weekday() == 6:
+                st.warning("⚠️ No trabajamos los domingos")
+            else:
+                st.warning("⚠️ No trabajamos en esta fecha")
             return
         
         # STEP 3: Time slot selection - MODIFIED FOR 20-MINUTE SLOTS
         st.subheader("🕐 Horarios Disponibles")
+        reservas_age = snapshot_age(RESERVAS_TABLE)
+        if reservas_age is not None:
+            st.caption(f"Disponibilidad actualizada hace {int(reservas_age)} s")
+        if STORAGE_BACKEND == "sheets" and SHEETS_QUOTA.constrained():
+            st.caption("⏳ Alta demanda en este momento: la disponibilidad puede tardar unos segundos más en actualizarse")
         
         # Show any persistent error message
         if st.session_state.slot_error_message:
             st.error(f"❌ {st.session_state.slot_error_message}")
         
-        # Get ALL possible slots and determine availability - MODIFIED
-        weekday_slots, saturday_slots = generate_all_20min_slots()
-        
-        if selected_date.weekday() == 5:  # Saturday
-            all_20min_slots = saturday_slots
-        else:  # Monday-Friday
-            all_20min_slots = weekday_slots
-
+        # Precomputed slot template for this date
+        template = get_day_template(selected_date)
 
-
-        # Special case: December 24, 2025 - only allow reservations until 3pm
-        if selected_date.year == 2025 and selected_date.month == 12 and selected_date.day == 24:
-            all_20min_slots = [slot for slot in all_20min_slots if int(slot.split(':')[0]) < 15]
-
-
-
-        # Get booked slots for this date
+        # Booked slots for this date from the per-day occupancy index
         target_date = selected_date.strftime('%Y-%m-%d')
-        date_mask = reservas_df['Fecha'].astype(str).str.contains(target_date, na=False)
-        booked_hours = reservas_df[date_mask]['Hora'].tolist()
-        booked_slots = parse_booked_slots(booked_hours)
+        dock_masks = get_occupancy_index(reservas_df).dock_masks(target_date)
         
-        # Generate display slots based on bultos - MODIFIED FOR 20-MINUTE SLOTS
-        if numero_bultos >= 8:
-            # For 8+ bultos, show all possible 60-minute slots with availability
-            display_slots = []
-            slots_needed = 3
-            for i in range(len(all_20min_slots) - (slots_needed - 1)):
-                current_slot = all_20min_slots[i]
-                slots_to_check = [current_slot]
-                temp_slot = current_slot
-                for j in range(1, slots_needed):
-                    temp_slot = get_next_slot(temp_slot)
-                    if i + j < len(all_20min_slots) and all_20min_slots[i + j] == temp_slot:
-                        slots_to_check.append(temp_slot)
-                    else:
-                        break
-                if len(slots_to_check) == slots_needed:
-                    is_available = all(slot not in booked_slots for slot in slots_to_check)
-                    display_slots.append((current_slot, is_available))
-        elif numero_bultos >= 4:
-            # For 4-7 bultos, show all possible 40-minute slots with availability
-            display_slots = []
-            slots_needed = 2
-            for i in range(len(all_20min_slots) - (slots_needed - 1)):
-                current_slot = all_20min_slots[i]
-                next_slot = get_next_slot(current_slot)
-                if i + 1 < len(all_20min_slots) and all_20min_slots[i + 1] == next_slot:
-                    is_available = current_slot not in booked_slots and next_slot not in booked_slots
-                    display_slots.append((current_slot, is_available))
-        else:
-            # For 1-3 bultos, show all 20-minute slots with availability
-            display_slots = [(slot, slot not in booked_slots) for slot in all_20min_slots]
+        # Every start that fits this delivery's duration, with availability
+        duration_minutes = slots_needed * SLOT_MINUTES
+        display_slots = get_slot_availability(template.mask, dock_masks, slots_needed)
         
         if not display_slots:
             st.warning("❌ No hay horarios para esta fecha")
@@ -1117,13 +4043,8 @@ def main():
             # First slot
             slot1, is_available1 = display_slots[i]
             
-            # Button text based on bultos and availability - MODIFIED
-            if numero_bultos >= 8:
-                button_text1 = f"✅ {slot1} (60min)" if is_available1 else f"🚫 {slot1} (Ocupado)"
-            elif numero_bultos >= 4:
-                button_text1 = f"✅ {slot1} (40min)" if is_available1 else f"🚫 {slot1} (Ocupado)"
-            else:
-                button_text1 = f"✅ {slot1} (20min)" if is_available1 else f"🚫 {slot1} (Ocupado)"
+            # Button text based on duration and availability
+            button_text1 = f"✅ {slot1} ({duration_minutes}min)" if is_available1 else f"🚫 {slot1} (Ocupado)"
             
             with col1:
                 if not is_available1:
@@ -1139,19 +4060,16 @@ def main():
                             st.session_state.slot_error_message = None
                         else:
                             st.session_state.slot_error_message = message
+                            # Cached grid showed this slot as free - refresh it
+                            invalidate_tables(RESERVAS_TABLE)
                             st.rerun()
             
             # Second slot (if exists)
             if i + 1 < len(display_slots):
                 slot2, is_available2 = display_slots[i + 1]
                 
-                # Button text based on bultos and availability - MODIFIED
-                if numero_bultos >= 8:
-                    button_text2 = f"✅ {slot2} (60min)" if is_available2 else f"🚫 {slot2} (Ocupado)"
-                elif numero_bultos >= 4:
-                    button_text2 = f"✅ {slot2} (40min)" if is_available2 else f"🚫 {slot2} (Ocupado)"
-                else:
-                    button_text2 = f"✅ {slot2} (20min)" if is_available2 else f"🚫 {slot2} (Ocupado)"
+                # Button text based on duration and availability
+                button_text2 = f"✅ {slot2} ({duration_minutes}min)" if is_available2 else f"🚫 {slot2} (Ocupado)"
                 
                 with col2:
                     if not is_available2:
@@ -1167,6 +4085,8 @@ def main():
                                 st.session_state.slot_error_message = None
                             else:
                                 st.session_state.slot_error_message = message
+                                # Cached grid showed this slot as free - refresh it
+                                invalidate_tables(RESERVAS_TABLE)
                                 st.rerun()
         
         # STEP 4: Enhanced Confirmation - MODIFIED FOR 20-MINUTE SLOTS
@@ -1185,7 +4105,7 @@ def main():
             st.info(f"📋 Órdenes de compra: {', '.join(valid_orders)}")
             
             # Confirm button
-            if st.button("✅ Confirmar Reserva", use_container_width=True):
+            if st.button("✅ Confirmar Reserva", use_container_width=True, disabled=read_only):
                 success = enhanced_confirmation_process(
                     selected_date,
                     st.session_state.selected_slot,